@@ -1,8 +1,9 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 from time import time
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Literal
 import asyncio
 import json
+import uuid
 
 from fastapi import APIRouter, Depends, HTTPException, Query
 from fastapi import Request
@@ -12,7 +13,12 @@ from fastapi.responses import StreamingResponse
 
 import redis.asyncio as aioredis
 from core.authentication import get_current_active_user, User
-from database.models import Tasks
+from tortoise import timezone
+from tortoise.expressions import Subquery
+
+from database.models import Tasks, ChatArchives
+from database.redis import register_lua_script, run_lua_script
+from core.codec import encode_message, decode_message, encode_archive
 from apps.schemas import SSETextChunk, SSEResponse
 from apps.schemas import Message
 from config import settings
@@ -33,6 +39,107 @@ def get_user_task_key(user_id: str) -> str:
     """获取用户任务列表在Redis中的键名"""
     return f"user_tasks:{user_id}"
 
+def get_user_task_index_key(user_id: str) -> str:
+    """获取用户任务按最近活跃时间排序的索引（ZSET）在Redis中的键名"""
+    return f"user_tasks_index:{user_id}"
+
+def get_message_body_key(user_id: str, task_id: str, message_id: str) -> str:
+    """获取助手消息正文（只追加字符串）在Redis中的键名"""
+    return f"message_body:{user_id}:{task_id}:{message_id}"
+
+def get_message_meta_key(user_id: str, task_id: str, message_id: str) -> str:
+    """获取助手消息元信息（status/parts/metadata等）在Redis中的键名"""
+    return f"message_meta:{user_id}:{task_id}:{message_id}"
+
+
+# 助手消息原子写入脚本
+# KEYS: 1 消息列表  2 正文  3 元信息  4 用户任务哈希  5 用户任务时间索引
+# ARGV: 1 message_id  2 列表中的引用  3 set/append  4 正文或增量  5 task_id  6 任务摘要
+#       7/8 旧消息正文/元信息键前缀  9 任务最近活跃时间  10.. 元信息字段与值
+UPSERT_ASSISTANT_MESSAGE_LUA = """
+local latest = nil
+local head = redis.call('LINDEX', KEYS[1], 0)
+if head then
+    -- 助手消息引用始终是 JSON；二进制编码的用户消息解析失败，按非助手消息处理
+    local ok, decoded = pcall(cjson.decode, head)
+    if ok and type(decoded) == 'table' then
+        latest = decoded
+    end
+end
+
+if latest and latest['role'] == 'assistant' then
+    local old_ref = latest['ref']
+    if old_ref ~= ARGV[1] then
+        redis.call('LSET', KEYS[1], 0, ARGV[2])
+        if type(old_ref) == 'string' then
+            redis.call('DEL', ARGV[7] .. old_ref, ARGV[8] .. old_ref)
+        end
+    end
+else
+    redis.call('LPUSH', KEYS[1], ARGV[2])
+end
+
+if ARGV[3] == 'set' then
+    redis.call('SET', KEYS[2], ARGV[4])
+elseif #ARGV[4] > 0 then
+    redis.call('APPEND', KEYS[2], ARGV[4])
+end
+
+if #ARGV > 9 then
+    redis.call('HSET', KEYS[3], unpack(ARGV, 10))
+end
+redis.call('HSET', KEYS[4], ARGV[5], ARGV[6])
+redis.call('ZADD', KEYS[5], ARGV[9], ARGV[5])
+return 1
+"""
+register_lua_script("upsert_assistant_message", UPSERT_ASSISTANT_MESSAGE_LUA)
+
+
+def _message_preview(content: str, status: Optional[str] = None) -> str:
+    """
+    生成任务列表中展示的 last_message 预览：
+    已完成的消息若是 SSE 包装或 JSON 且包含 answer，只取 answer；最后截断到 MAX_MESSAGE_LENGTH。
+    """
+    display_message = content or ""
+    if status != "in_progress":
+        try:
+            # 首先，尝试将字符串中的事件部分（如 'event: message_end\ndata: '）去掉
+            if display_message.startswith('event: message_end'):
+                json_str = display_message.split('data: ', 1)[1].strip()
+                message_content = json.loads(json_str)
+                if 'answer' in message_content:
+                    display_message = message_content['answer']
+            elif display_message.startswith('{'):
+                # 如果不是 SSE 格式，也尝试直接解析
+                message_content = json.loads(display_message)
+                if 'answer' in message_content:
+                    display_message = message_content['answer']
+        except (json.JSONDecodeError, IndexError, TypeError):
+            # 如果解析失败或格式不符，则保持原始消息
+            pass
+    if len(display_message) > settings.MAX_MESSAGE_LENGTH:
+        display_message = display_message[:settings.MAX_MESSAGE_LENGTH] + "..."
+    return display_message
+
+
+def _build_task_info(task_id: str, task_type: str, conversation_id: str, message: Message) -> Dict[str, Any]:
+    """构造用户任务列表中的任务摘要，last_message 在写入时即截断为预览"""
+    return {
+        "task_id": task_id,
+        "task_type": task_type,
+        "conversation_id": conversation_id, # 新增
+        "last_message": _message_preview(message.content, message.status),
+        "last_timestamp": message.timestamp.timestamp()
+    }
+
+
+async def remove_user_task(user_id: str, task_id: str, redis_client: aioredis.Redis):
+    """从用户任务列表及其时间索引中移除任务"""
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hdel(get_user_task_key(user_id), task_id)
+        pipe.zrem(get_user_task_index_key(user_id), task_id)
+        await pipe.execute()
+
 
 # 保存对话消息
 async def save_or_update_message_in_redis(
@@ -46,74 +153,470 @@ async def save_or_update_message_in_redis(
     """
     保存或更新消息到Redis。
     - 如果是用户消息，则总是新增。
-    - 如果是助手消息，则更新最新的助手消息快照。
+    - 如果是助手消息，则以完整快照覆盖最新的助手消息（增量写入见 append_assistant_message_delta）。
     """
     try:
+        if message.role == "assistant":
+            await append_assistant_message_delta(
+                user_id, task_id, task_type, conversation_id, message, redis_client, delta=None
+            )
+            return
 
         message_data = message.model_dump(mode="json")
         message_data["timestamp"] = message.timestamp.timestamp() # 转换为时间戳
 
         message_key = get_message_key(user_id, task_id)
-
-
-        if message.role == "assistant":
-            # 尝试更新最新的消息（如果是助手消息）
-            latest_message_json = await redis_client.lindex(message_key, 0)
-            if latest_message_json:
-                latest_message = json.loads(latest_message_json)
-                if latest_message.get("role") == "assistant":
-                    # 更新现有助手消息
-                    await redis_client.lset(message_key, 0, json.dumps(message_data))
-                else:
-                    # 最新的不是助手消息，则新增
-                    await redis_client.lpush(message_key, json.dumps(message_data))
-            else:
-                # 列表为空，直接新增
-                await redis_client.lpush(message_key, json.dumps(message_data))
-        else:
-            # 用户消息总是新增
-            await redis_client.lpush(message_key, json.dumps(message_data))
-
-        
-        # 更新用户任务列表
         user_task_key = get_user_task_key(user_id)
-        task_info = {
-            "task_id": task_id,
-            "task_type": task_type,
-            "conversation_id": conversation_id, # 新增
-            "last_message": message.content, # message.content[:settings.MAX_MESSAGE_LENGTH] + "..." if len(message.content) > settings.MAX_MESSAGE_LENGTH else message.content,
-            "last_timestamp": message.timestamp.timestamp()
-        }
-        await redis_client.hset(user_task_key, task_id, json.dumps(task_info))
+        task_info = _build_task_info(task_id, task_type, conversation_id, message)
 
+        # 用户消息总是新增，同时更新用户任务列表
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.lpush(message_key, encode_message(message_data))
+            pipe.hset(user_task_key, task_id, json.dumps(task_info))
+            pipe.zadd(get_user_task_index_key(user_id), {task_id: task_info["last_timestamp"]})
+            await pipe.execute()
 
     except Exception as e:
         print(f"保存消息失败 - 用户: {user_id}, 任务: {task_id}..., 错误: {e}")
         raise
 
+
+async def append_assistant_message_delta(
+        user_id: str,
+        task_id: str,
+        task_type: str,
+        conversation_id: str,
+        message: Message,
+        redis_client: aioredis.Redis,
+        delta: Optional[str] = None,
+        ):
+    """
+    以增量方式保存助手消息。
+    - 消息列表中只存一个引用 {"role": "assistant", "ref": message_id, ...}
+    - 正文存放在只追加的字符串中，delta 为新增文本；delta 为 None 时整体覆盖正文
+    - status/parts/metadata/timestamp 存放在小哈希中
+    这样每次写入的开销只与新增内容有关，与回答总长度无关。
+    """
+    if not message.message_id:
+        message.message_id = uuid.uuid4().hex
+    message_id = message.message_id
+
+    message_key = get_message_key(user_id, task_id)
+    body_key = get_message_body_key(user_id, task_id, message_id)
+    meta_key = get_message_meta_key(user_id, task_id, message_id)
+    user_task_key = get_user_task_key(user_id)
+
+    timestamp = message.timestamp.timestamp()
+    # 引用很小且需要在 Lua 中解析，固定使用 JSON
+    stub = json.dumps({"role": "assistant", "ref": message_id, "timestamp": timestamp})
+    meta = {
+        "role": message.role,
+        "timestamp": timestamp,
+        "status": message.status or "",
+        "parts": encode_message(message.parts),
+        "metadata": encode_message(message.metadata),
+    }
+    task_info = _build_task_info(task_id, task_type, conversation_id, message)
+
+    if delta is None:
+        mode, body = "set", message.content
+    else:
+        mode, body = "append", delta
+
+    # “更新最新助手消息或新增 + 刷新用户任务列表”在一个脚本内原子完成，一次往返
+    await run_lua_script(
+        redis_client,
+        "upsert_assistant_message",
+        keys=[message_key, body_key, meta_key, user_task_key, get_user_task_index_key(user_id)],
+        args=[
+            message_id, stub, mode, body, task_id, json.dumps(task_info),
+            get_message_body_key(user_id, task_id, ""), get_message_meta_key(user_id, task_id, ""),
+            task_info["last_timestamp"],
+            *[item for pair in meta.items() for item in pair],
+        ],
+    )
+
+
+class MessageWriteBuffer:
+    """
+    流式输出期间助手消息的写回缓冲（write-behind）。
+    - save() 只记录最新快照，满足时间预算或字节预算时才真正写入Redis
+    - 消息状态为 done/failed 或 parts 发生变化时强制落盘
+    - 流暂停时由后台定时器在时间预算内补一次落盘，保证崩溃后可恢复
+    """
+    def __init__(
+            self,
+            user_id: str,
+            task_id: str,
+            task_type: str,
+            conversation_id: str,
+            redis_client: aioredis.Redis,
+            flush_interval: Optional[float] = None,
+            flush_bytes: Optional[int] = None,
+    ):
+        self.user_id = user_id
+        self.task_id = task_id
+        self.task_type = task_type
+        self.conversation_id = conversation_id
+        self.redis_client = redis_client
+        self.flush_interval = settings.MESSAGE_FLUSH_INTERVAL if flush_interval is None else flush_interval
+        self.flush_bytes = settings.MESSAGE_FLUSH_BYTES if flush_bytes is None else flush_bytes
+
+        self._pending: Optional[Message] = None
+        self._flushed_length = 0
+        self._flushed_tail = ""
+        self._flushed_parts = 0
+        self._last_flush = asyncio.get_running_loop().time()
+        self._lock = asyncio.Lock()
+        self._timer: Optional[asyncio.Task] = None
+
+    async def save(self, message: Message, force: bool = False):
+        """记录消息快照，按预算决定是否立即落盘"""
+        self._pending = message
+        parts_count = len(message.parts or [])
+        now = asyncio.get_running_loop().time()
+        if (
+            force
+            or message.status in ("done", "failed")
+            or parts_count != self._flushed_parts
+            or abs(len(message.content) - self._flushed_length) >= self.flush_bytes
+            or now - self._last_flush >= self.flush_interval
+        ):
+            await self.flush()
+        elif self._timer is None or self._timer.done():
+            self._timer = asyncio.create_task(self._delayed_flush(self.flush_interval - (now - self._last_flush)))
+
+    async def flush(self):
+        """将最新快照写入Redis（没有待写内容时直接返回）"""
+        async with self._lock:
+            message = self._pending
+            if message is None:
+                return
+            self._pending = None
+            if self._timer and not self._timer.done() and self._timer is not asyncio.current_task():
+                self._timer.cancel()
+            self._timer = None
+            # 自上次落盘后正文只是追加时只写新增部分，否则整体覆盖
+            content = message.content
+            if (
+                message.role == "assistant"
+                and len(content) >= self._flushed_length
+                and content[max(self._flushed_length - 64, 0):self._flushed_length] == self._flushed_tail
+            ):
+                await append_assistant_message_delta(
+                    self.user_id, self.task_id, self.task_type, self.conversation_id,
+                    message, self.redis_client, delta=content[self._flushed_length:]
+                )
+            else:
+                await save_or_update_message_in_redis(
+                    user_id=self.user_id, task_id=self.task_id, task_type=self.task_type,
+                    conversation_id=self.conversation_id, message=message, redis_client=self.redis_client
+                )
+            self._flushed_length = len(content)
+            self._flushed_tail = content[-64:]
+            self._flushed_parts = len(message.parts or [])
+            self._last_flush = asyncio.get_running_loop().time()
+
+    async def _delayed_flush(self, delay: float):
+        await asyncio.sleep(max(delay, 0))
+        try:
+            await self.flush()
+        except Exception as e:
+            print(f"定时落盘失败 - 用户: {self.user_id}, 任务: {self.task_id}..., 错误: {e}")
+
+    def close(self):
+        """
+        流被取消时调用：把未落盘的快照交给独立任务写入，
+        避免在已取消的生成器里继续 await。
+        """
+        if self._pending is None:
+            return
+        if self._timer and not self._timer.done():
+            self._timer.cancel()
+        task = asyncio.create_task(self.flush())
+        _background_flushes.add(task)
+        task.add_done_callback(_background_flushes.discard)
+
+
+# 保存被取消流的收尾落盘任务，防止被垃圾回收
+_background_flushes: set = set()
+
 # 保存对话消息 (保留旧函数以兼容，或标记为废弃)
 async def save_message_to_redis(user_id: str, task_id: str, task_type: str, conversation_id: str, message:Message, redis_client:aioredis.Redis):
     # 为保持兼容性，此函数现在直接调用新的更新函数
     await save_or_update_message_in_redis(user_id, task_id, task_type, conversation_id, message, redis_client)
 
-async def get_messages_history(user_id: str, task_id: str, redis_client: aioredis.Redis) -> List[Dict[str, Any]]:
+# 可投影的消息字段
+MESSAGE_FIELDS = ("role", "content", "timestamp", "metadata", "parts", "status", "message_id")
+
+
+async def get_messages_history(
+        user_id: str,
+        task_id: str,
+        redis_client: aioredis.Redis,
+        fields: Optional[List[str]] = None
+) -> List[Dict[str, Any]]:
     # 从Redis获取对话历史消息
     try:
         if settings.REDIS_AVAILABLE and redis_client:
             message_key = get_message_key(user_id, task_id)
             messages = await redis_client.lrange(message_key, 0, -1)
+            # Redis 未命中时从归档回填
+            if not messages and await restore_archived_history(user_id, task_id, redis_client):
+                messages = await redis_client.lrange(message_key, 0, -1)
 
             # 反转消息顺序（Redis中是倒序存储的）
             messages.reverse()
 
-            history = [json.loads(msg) for msg in messages]
-            return history
+            history = [decode_message(msg) for msg in messages]
+            return await _resolve_message_refs(user_id, task_id, history, redis_client, fields)
         else:
             raise NotImplementedError
     except Exception as e:
         print(f"获取历史消息失败 - 用户: {user_id}, 任务: {task_id}..., 错误: {e}")
         raise
 
+
+async def get_messages_page(
+        user_id: str,
+        task_id: str,
+        redis_client: aioredis.Redis,
+        cursor: Optional[int] = None,
+        limit: int = 20,
+        order: str = "desc",
+        fields: Optional[List[str]] = None
+) -> Dict[str, Any]:
+    """
+    分页获取对话历史，只读取 LRANGE 窗口内的消息。
+    游标以列表尾部（最早一条）为起点计数，新消息 LPUSH 到头部不会使已发出的游标错位：
+    - asc：cursor 为已读取的最早消息条数，不传从最早一条开始
+    - desc：cursor 为上一页返回的 next_cursor，即尚未读取的更早消息条数，不传从最新一条开始
+    - 返回 next_cursor，为 None 时表示没有更多
+    """
+    if not (settings.REDIS_AVAILABLE and redis_client):
+        raise NotImplementedError
+    message_key = get_message_key(user_id, task_id)
+
+    # Redis中最新消息在下标0，最早消息在下标-1；从尾部第 n 条（0 起）的下标为 -(n + 1)
+    if order == "desc" and cursor is not None:
+        start, stop = -cursor, -(max(cursor - limit, 0) + 1)
+    elif order == "desc":
+        start, stop = 0, limit - 1
+    else:
+        cursor = cursor or 0
+        start, stop = -(cursor + limit), -(cursor + 1)
+
+    async def read_window():
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.llen(message_key)
+            pipe.lrange(message_key, start, stop)
+            return await pipe.execute()
+
+    if order == "desc" and cursor is not None and cursor <= 0:
+        total, messages = await redis_client.llen(message_key), []
+    else:
+        total, messages = await read_window()
+        # Redis 未命中时从归档回填
+        if not total and await restore_archived_history(user_id, task_id, redis_client):
+            total, messages = await read_window()
+
+    if order == "asc":
+        messages.reverse()
+
+    page = [decode_message(msg) for msg in messages]
+    page = await _resolve_message_refs(user_id, task_id, page, redis_client, fields)
+    if order == "desc":
+        # 本页最早一条之前还有多少条
+        next_cursor = (min(cursor, total) if cursor is not None else total) - len(page)
+        next_cursor = next_cursor if next_cursor > 0 else None
+    else:
+        next_cursor = cursor + len(page)
+        next_cursor = next_cursor if next_cursor < total else None
+    return {
+        "messages": page,
+        "total": total,
+        "next_cursor": next_cursor,
+    }
+
+
+async def _resolve_message_refs(
+        user_id: str,
+        task_id: str,
+        history: List[Dict[str, Any]],
+        redis_client: aioredis.Redis,
+        fields: Optional[List[str]] = None
+) -> List[Dict[str, Any]]:
+    """
+    将增量存储的助手消息引用还原为完整消息，旧格式的完整快照原样返回。
+    指定 fields 时只读取并返回这些字段，不需要正文时不读取 message_body。
+    """
+    refs = [(i, msg["ref"]) for i, msg in enumerate(history) if msg.get("ref")]
+    need_body = fields is None or "content" in fields
+    meta_fields = [f for f in (fields or MESSAGE_FIELDS) if f not in ("content", "message_id")]
+
+    if refs:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for _, message_id in refs:
+                if need_body:
+                    pipe.get(get_message_body_key(user_id, task_id, message_id))
+                if meta_fields:
+                    pipe.hmget(get_message_meta_key(user_id, task_id, message_id), meta_fields)
+            results = iter(await pipe.execute())
+
+        for i, message_id in refs:
+            body = next(results) if need_body else None
+            meta = dict(zip(meta_fields, next(results))) if meta_fields else {}
+            history[i] = {
+                "role": meta.get("role") or "assistant",
+                "content": body or "",
+                "timestamp": float(meta.get("timestamp") or history[i].get("timestamp") or 0),
+                "metadata": decode_message(meta["metadata"]) if meta.get("metadata") else None,
+                "parts": decode_message(meta["parts"]) if meta.get("parts") else None,
+                "status": meta.get("status") or None,
+                "message_id": message_id,
+            }
+
+    if fields is not None:
+        history = [{k: msg.get(k) for k in fields} for msg in history]
+    return history
+
+
+async def delete_messages_history(user_id: str, task_id: str, redis_client: aioredis.Redis):
+    """删除任务的消息列表、增量存储的助手消息正文/元信息以及归档；未启用 Redis 时只删除归档"""
+    if settings.REDIS_AVAILABLE and redis_client:
+        message_key = get_message_key(user_id, task_id)
+        messages = await redis_client.lrange(message_key, 0, -1)
+        await _delete_message_keys(user_id, task_id, messages, redis_client)
+
+    # 归档以整数 ID 存储，非数字 ID 不可能有归档
+    try:
+        archive_task_id, archive_user_id = int(task_id), int(user_id)
+    except (TypeError, ValueError):
+        return
+    await ChatArchives.filter(task_id=archive_task_id, user_id=archive_user_id).delete()
+
+
+async def _delete_message_keys(user_id: str, task_id: str, messages: List[Any], redis_client: aioredis.Redis):
+    """删除消息列表及其引用的正文/元信息 key"""
+    keys = [get_message_key(user_id, task_id)]
+    for msg in messages:
+        ref = decode_message(msg).get("ref")
+        if ref:
+            keys.append(get_message_body_key(user_id, task_id, ref))
+            keys.append(get_message_meta_key(user_id, task_id, ref))
+    await redis_client.delete(*keys)
+
+
+# ---------- 冷数据归档 ----------
+# 已完成/失败且长期未更新的任务，对话历史整体压缩后移入 SQL（chat_archives），
+# 侧边栏的 user_tasks 信息保留；访问时回填到 Redis 并设置过期时间。
+
+ARCHIVER_LOCK_KEY = "chat_archiver_lock"
+
+
+async def archive_task_history(user_id: str, task_id: str, redis_client: aioredis.Redis) -> int:
+    """将单个任务的对话历史写入归档并从 Redis 删除，返回归档的消息条数"""
+    message_key = get_message_key(user_id, task_id)
+    messages = await redis_client.lrange(message_key, 0, -1)
+    history = [decode_message(msg) for msg in reversed(messages)]
+    history = await _resolve_message_refs(user_id, task_id, history, redis_client)
+
+    # 没有历史的任务也写一条空归档，避免每轮重复扫描
+    await ChatArchives.update_or_create(
+        defaults={
+            "user_id": int(user_id),
+            "payload": encode_archive(history),
+            "message_count": len(history),
+        },
+        task_id=int(task_id),
+    )
+    if not messages:
+        return 0
+
+    # 归档期间有新消息写入则放弃本次归档，等下一轮
+    if await redis_client.llen(message_key) != len(messages):
+        await ChatArchives.filter(task_id=int(task_id)).delete()
+        return 0
+    await _delete_message_keys(user_id, task_id, messages, redis_client)
+    return len(history)
+
+
+async def restore_archived_history(
+        user_id: str,
+        task_id: str,
+        redis_client: aioredis.Redis,
+        persist: bool = False
+) -> bool:
+    """
+    将归档的对话历史回填到 Redis，返回 Redis 中是否有可读的历史。
+    - persist=False：只读访问，回填的数据 ARCHIVE_REWARM_TTL 秒后过期，归档保留
+    - persist=True：任务将继续写入新消息，回填的数据不过期并删除归档
+    未启用 Redis 时无处回填，返回 False。
+    """
+    if not (settings.REDIS_AVAILABLE and redis_client):
+        return False
+    message_key = get_message_key(user_id, task_id)
+    if await redis_client.exists(message_key):
+        # 已回填过：继续写入前去掉过期时间，避免新消息随之过期
+        if persist and await redis_client.ttl(message_key) > 0:
+            await redis_client.persist(message_key)
+            await ChatArchives.filter(task_id=int(task_id), user_id=int(user_id)).delete()
+        return True
+
+    archive = await ChatArchives.get_or_none(task_id=int(task_id), user_id=int(user_id))
+    if not archive:
+        return False
+    history = decode_message(archive.payload) if archive.message_count else []
+    if history:
+        async with redis_client.pipeline(transaction=True) as pipe:
+            # 逐条 LPUSH 后最新一条位于下标0，与正常写入一致
+            pipe.lpush(message_key, *[encode_message(msg) for msg in history])
+            if not persist:
+                pipe.expire(message_key, settings.ARCHIVE_REWARM_TTL)
+            await pipe.execute()
+    if persist:
+        await archive.delete()
+    return bool(history)
+
+
+async def archive_cold_histories(redis_client: aioredis.Redis) -> int:
+    """归档一批冷任务，返回处理的任务数"""
+    cutoff = timezone.now() - timedelta(days=settings.ARCHIVE_AFTER_DAYS)
+    tasks = await Tasks.filter(
+        status__in=("done", "failed"),
+        updated_at__lt=cutoff,
+    ).exclude(
+        task_id__in=Subquery(ChatArchives.all().values("task_id"))
+    ).order_by("updated_at").limit(settings.ARCHIVE_BATCH_SIZE).values("task_id", "user_id")
+
+    archived_messages = 0
+    for task in tasks:
+        try:
+            archived_messages += await archive_task_history(str(task["user_id"]), str(task["task_id"]), redis_client)
+        except Exception as e:
+            print(f"归档对话历史失败 - 用户: {task['user_id']}, 任务: {task['task_id']}, 错误: {e}")
+    if tasks:
+        print(f"已归档 {len(tasks)} 个任务的对话历史，共 {archived_messages} 条消息")
+    return len(tasks)
+
+
+async def run_history_archiver(redis_client: aioredis.Redis):
+    """后台归档循环，多个 worker 通过 Redis 锁保证同一时间只有一个在执行"""
+    while True:
+        try:
+            if settings.REDIS_AVAILABLE and redis_client and await redis_client.set(
+                ARCHIVER_LOCK_KEY, "1", nx=True, ex=settings.ARCHIVE_INTERVAL
+            ):
+                # 一批处理满时紧接着处理下一批
+                while await archive_cold_histories(redis_client) >= settings.ARCHIVE_BATCH_SIZE:
+                    await asyncio.sleep(0)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"对话历史归档任务异常: {e}")
+        await asyncio.sleep(settings.ARCHIVE_INTERVAL)
+
+
 async def generate_stream_respone(
     user_id: str,
     task_id: str,
@@ -169,81 +672,125 @@ async def get_task_history(
     request: Request,
     #user_id: str = Query(..., description="用户ID"),
     task_id: str = Query(..., description="任务ID"),
+    cursor: Optional[int] = Query(None, ge=0, description="分页游标，传上一页返回的 next_cursor，不传从第一页开始"),
+    limit: Optional[int] = Query(None, ge=1, le=200, description="每页条数，不传则返回全部历史"),
+    order: Literal["desc", "asc"] = Query("desc", description="分页顺序，desc 为从最新开始"),
+    fields: Optional[str] = Query(None, description="只返回指定字段，逗号分隔，如 role,status,timestamp"),
     current_user: User = Depends(get_current_active_user),
 ):
     redis_client = request.app.state.redis
     """获取对话历史记录"""
 
+    field_list = None
+    if fields:
+        field_list = [f.strip() for f in fields.split(",") if f.strip()]
+        unknown = set(field_list) - set(MESSAGE_FIELDS)
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"未知字段: {', '.join(sorted(unknown))}")
+
     try:
-        history = await get_messages_history(current_user.user_id, task_id, redis_client)
+        if limit is None:
+            history = await get_messages_history(current_user.user_id, task_id, redis_client, field_list)
+            return {
+                "task_id": task_id,
+                "message": history,
+                "total": len(history)
+            }
+
+        page = await get_messages_page(
+            current_user.user_id, task_id, redis_client,
+            cursor=cursor, limit=limit, order=order, fields=field_list
+        )
         return {
             "task_id": task_id,
-            "message": history,
-            "total": len(history)
+            "message": page["messages"],
+            "total": page["total"],
+            "next_cursor": page["next_cursor"]
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail="获取聊天历史失败")
 
 
+async def _rebuild_user_task_index(user_id: str, redis_client: aioredis.Redis) -> int:
+    """
+    旧数据只有 user_tasks 哈希（或索引不完整）时，一次性补建时间索引，并把 last_message 改写为预览。
+    返回补建的任务数。
+    """
+    user_task_key = get_user_task_key(user_id)
+    tasks_data = await redis_client.hgetall(user_task_key)
+    if not tasks_data:
+        return 0
+
+    scores = {}
+    rewritten = {}
+    for task_id, task_info in tasks_data.items():
+        task_data = json.loads(task_info)
+        task_data["last_message"] = _message_preview(task_data.get("last_message", ""))
+        scores[task_id] = float(task_data.get("last_timestamp") or 0)
+        rewritten[task_id] = json.dumps(task_data)
+
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(user_task_key, mapping=rewritten)
+        pipe.zadd(get_user_task_index_key(user_id), scores)
+        await pipe.execute()
+    return len(scores)
+
+
 @router.get("/history",summary="获取用户对话历史记录")
 async def get_user_history(
     request: Request,
     #user_id: str = Query(..., description="用户ID"),
+    cursor: int = Query(0, ge=0, description="分页游标，即已读取的任务数"),
+    limit: Optional[int] = Query(None, ge=1, le=500, description="每页任务数，不传则返回全部"),
     current_user: User = Depends(get_current_active_user),
 ):
     redis_client = request.app.state.redis
     """
-    获取对话历史记录
+    获取对话历史记录，按最近活跃时间倒序，由 ZSET 索引分页
     """
     try:
         history = []
         if settings.REDIS_AVAILABLE and redis_client:
             user_task_key = get_user_task_key(current_user.user_id)
-            tasks_data = await redis_client.hgetall(user_task_key)
-
-            for task_id, task_info in tasks_data.items():
+            index_key = get_user_task_index_key(current_user.user_id)
+
+            async with redis_client.pipeline(transaction=False) as pipe:
+                pipe.zcard(index_key)
+                pipe.hlen(user_task_key)
+                total, hash_total = await pipe.execute()
+            if hash_total > total:
+                total = await _rebuild_user_task_index(current_user.user_id, redis_client)
+
+            stop = -1 if limit is None else cursor + limit - 1
+            task_ids = await redis_client.zrevrange(index_key, cursor, stop)
+            tasks_data = await redis_client.hmget(user_task_key, task_ids) if task_ids else []
+
+            stale_ids = []
+            for task_id, task_info in zip(task_ids, tasks_data):
+                if task_info is None:
+                    # 哈希中已不存在的任务，顺手清理索引
+                    stale_ids.append(task_id)
+                    continue
                 task_data =  json.loads(task_info)
-                
-                last_message_str = task_data.get("last_message", "")
-                display_message = last_message_str
-                
-                # 尝试解析 last_message，如果它是 JSON 并且包含 answer 字段，则只显示 answer
-                try:
-                    # 首先，尝试将字符串中的事件部分（如 'event: message_end\ndata: '）去掉
-                    if last_message_str.startswith('event: message_end'):
-                        # 提取 JSON 部分
-                        json_str = last_message_str.split('data: ', 1)[1].strip()
-                        message_content = json.loads(json_str)
-                        if 'answer' in message_content:
-                            display_message = message_content['answer']
-                    else:
-                        # 如果不是 SSE 格式，也尝试直接解析
-                        message_content = json.loads(last_message_str)
-                        if 'answer' in message_content:
-                            display_message = message_content['answer']
-                except (json.JSONDecodeError, IndexError, TypeError):
-                    # 如果解析失败或格式不符，则保持原始消息
-                    display_message = last_message_str
-
                 history.append({
                     "task_id": task_id,
                     "conversation_id": task_data.get("conversation_id"), # 新增
                     "task_type": task_data.get("task_type", "未知类型"),
-                    "last_message": display_message,
+                    "last_message": task_data.get("last_message", ""),
                     "last_timestamp": task_data.get("last_timestamp", ""),
                     "last_time": datetime.fromtimestamp(task_data["last_timestamp"]).strftime("%Y-%m-%d %H:%M:%S")
                 })
+            if stale_ids:
+                await redis_client.zrem(index_key, *stale_ids)
         else:
             raise NotImplementedError
-        
-        # 按时间戳降序排序
-        history.sort(key=lambda x: x.get('last_timestamp', 0), reverse=True)
-        
-                             
+
+        next_cursor = cursor + len(task_ids)
         return {
             "user_id": current_user.user_id,
             "history": history,
-            "total": len(history)
+            "total": total,
+            "next_cursor": next_cursor if limit is not None and next_cursor < total else None
             }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取用户历史失败: {str(e)}")
@@ -257,18 +804,11 @@ async def delete_task(
 ):
     redis_client = request.app.state.redis
     try:
+        #删除对话历史（未启用 Redis 时只删除归档）
+        await delete_messages_history(current_user.user_id, task_id, redis_client)
         if settings.REDIS_AVAILABLE and redis_client:
-            # 从Redis删除任务历史
-            message_key = get_message_key(current_user.user_id, task_id)
-            user_task_key = get_user_task_key(current_user.user_id)
-
-            #输出对话历史
-            await redis_client.delete(message_key)
-
             # 删除用户任务列表中的该任务
-            await redis_client.hdel(user_task_key, task_id)
-        else:
-            raise NotImplementedError
+            await remove_user_task(current_user.user_id, task_id, redis_client)
         
 
         return {"message": "任务历史已清除", "task_id": task_id, "user_id": current_user.user_id}
@@ -296,16 +836,18 @@ async def clear_task_history(
                 raise HTTPException(status_code=404, detail="任务未找到")
 
             # 2. 从Redis删除对话历史
-            message_key = get_message_key(current_user.user_id, task_id)
-            await redis_client.delete(message_key)
+            await delete_messages_history(current_user.user_id, task_id, redis_client)
 
             # 3. 更新任务信息
             task_data = json.loads(existing_task_info_str)
             task_data["last_message"] = "对话历史已清除"
             task_data["last_timestamp"] = time()
 
-            # 4. 将更新后的信息存回
-            await redis_client.hset(user_task_key, task_id, json.dumps(task_data))
+            # 4. 将更新后的信息存回，并刷新时间索引
+            async with redis_client.pipeline(transaction=True) as pipe:
+                pipe.hset(user_task_key, task_id, json.dumps(task_data))
+                pipe.zadd(get_user_task_index_key(current_user.user_id), {task_id: task_data["last_timestamp"]})
+                await pipe.execute()
         else:
             raise NotImplementedError
         
@@ -0,0 +1,147 @@
+from typing import Optional, AsyncIterator, Union
+import asyncio
+import re
+
+import redis.asyncio as aioredis
+
+from config import settings
+
+
+# 任务执行过程中发送给前端的 SSE 事件，按任务记录到 Redis Stream：
+# - 每个事件的 Stream ID 作为 SSE 的 id:，单调递增
+# - 断线重连时按 Last-Event-ID 只补发缺失的事件，再接上实时事件
+# - 执行结束写入 eof 标记，之后日志保留 TASK_EVENT_TTL 秒
+
+EOF_FIELD = "eof"
+FRAME_FIELD = "frame"
+START_FIELD = "start"
+
+# 断线后仍需写完 eof 的独立任务，防止被 GC 回收
+_background_writes: set = set()
+
+
+def get_task_event_key(task_id: str) -> str:
+    """生成任务事件日志的Redis键名"""
+    return f"task_events:{task_id}"
+
+
+_EVENT_ID_PATTERN = re.compile(r"\d+(-\d+)?")
+
+
+def is_valid_event_id(event_id: str) -> bool:
+    """是否为合法的 Stream ID（ms 或 ms-seq），非法值传给 XRANGE 会报错"""
+    return bool(_EVENT_ID_PATTERN.fullmatch(event_id))
+
+
+async def task_event_log_exists(redis_client: aioredis.Redis, task_id: str) -> bool:
+    """任务的事件日志是否存在（执行开始时即写入开始标记，结束后保留 TASK_EVENT_TTL 秒）"""
+    return bool(await redis_client.exists(get_task_event_key(task_id)))
+
+
+def _with_event_id(event_id: str, frame: Union[str, bytes]) -> Union[str, bytes]:
+    """为 SSE 帧加上 id: 行，bytes 帧（core/sse.py）保持 bytes"""
+    if isinstance(frame, bytes):
+        return b"id: " + event_id.encode("utf-8") + b"\n" + frame
+    return f"id: {event_id}\n{frame}"
+
+
+class TaskEventLog:
+    """单个任务的有界事件日志"""
+    def __init__(self, redis_client: aioredis.Redis, task_id: str):
+        self.redis_client = redis_client
+        self.key = get_task_event_key(task_id)
+
+    async def reset(self):
+        """
+        新一轮执行开始时清空上一轮的事件（在启动任务前调用，避免订阅者读到上一轮的 eof），
+        并写入开始标记，使第一个事件产生前日志也存在。
+        """
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            pipe.delete(self.key)
+            pipe.xadd(self.key, {START_FIELD: "1"}, maxlen=settings.TASK_EVENT_MAXLEN, approximate=True)
+            await pipe.execute()
+
+    async def append(self, frame: Union[str, bytes]) -> str:
+        """记录一个 SSE 帧，返回其事件 ID"""
+        return await self.redis_client.xadd(
+            self.key, {FRAME_FIELD: frame},
+            maxlen=settings.TASK_EVENT_MAXLEN, approximate=True
+        )
+
+    async def close(self):
+        """写入结束标记，并让日志在一段时间后过期"""
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            pipe.xadd(self.key, {EOF_FIELD: "1"}, maxlen=settings.TASK_EVENT_MAXLEN, approximate=True)
+            pipe.expire(self.key, settings.TASK_EVENT_TTL)
+            await pipe.execute()
+
+
+async def record_task_events(
+        generator: AsyncIterator[Union[str, bytes]],
+        redis_client: aioredis.Redis,
+        task_id: str
+) -> AsyncIterator[Union[str, bytes]]:
+    """包装任务的 SSE 生成器：每个事件先写入事件日志，再带上 id: 交给调用方"""
+    if not (settings.REDIS_AVAILABLE and redis_client):
+        async for frame in generator:
+            yield frame
+        return
+
+    event_log = TaskEventLog(redis_client, task_id)
+    try:
+        async for frame in generator:
+            event_id = await event_log.append(frame)
+            yield _with_event_id(event_id, frame)
+    finally:
+        # 客户端断开时生成器已被取消，结束标记交给独立任务写入
+        task = asyncio.create_task(event_log.close())
+        _background_writes.add(task)
+        task.add_done_callback(_background_writes.discard)
+
+
+async def stream_task_events(
+        redis_client: aioredis.Redis,
+        task_id: str,
+        last_event_id: Optional[str] = None
+) -> AsyncIterator[str]:
+    """
+    读取任务事件：先用 XRANGE 补发 last_event_id 之后的事件，再用 XREAD BLOCK 跟随实时事件。
+    遇到 eof 标记或日志不存在时结束。
+    """
+    key = get_task_event_key(task_id)
+    last_id = last_event_id or "0-0"
+
+    # 1. 补发缺失的事件
+    while True:
+        entries = await redis_client.xrange(key, min=f"({last_id}", max="+", count=settings.TASK_EVENT_BATCH)
+        for event_id, fields in entries:
+            last_id = event_id
+            if EOF_FIELD in fields:
+                return
+            if FRAME_FIELD in fields:
+                yield _with_event_id(event_id, fields[FRAME_FIELD])
+        if len(entries) < settings.TASK_EVENT_BATCH:
+            break
+
+    # 执行期间日志始终存在（开始标记），不存在说明已过期或从未执行，无需阻塞等待
+    if not await redis_client.exists(key):
+        return
+
+    # 2. 跟随实时事件
+    while True:
+        result = await redis_client.xread(
+            {key: last_id}, count=settings.TASK_EVENT_BATCH, block=settings.TASK_EVENT_BLOCK_MS
+        )
+        if not result:
+            if not await redis_client.exists(key):
+                return
+            # 空闲时发送注释行保活，避免代理断开连接
+            yield ": keep-alive\n\n"
+            continue
+        for _, entries in result:
+            for event_id, fields in entries:
+                last_id = event_id
+                if EOF_FIELD in fields:
+                    return
+                if FRAME_FIELD in fields:
+                    yield _with_event_id(event_id, fields[FRAME_FIELD])
@@ -5,22 +5,26 @@ import http.client
 import httpx
 import os
 
-import aiohttp
+from contextlib import asynccontextmanager
 from pathlib import Path
 from fastapi import APIRouter
 from fastapi import HTTPException
 from fastapi import Depends
 import uuid
+import time
 import asyncio
 from database.models import Conversations
 from core.authentication import get_current_active_user
 from core.authentication import User
 from database.models import Tasks
-from apps.chat import save_or_update_message_in_redis
+from apps.chat import MessageWriteBuffer, get_messages_page
+from apps.geometry_cache import geometry_cache_key, replay_geometry_cache, store_geometry_cache
 from database.models import Tasks, Conversations, GeometryResults
 
 
 from config import settings
+from core import sse
+from core.resilience import call_idempotent, get_circuit_breaker
 
 from apps.schemas import FileItem
 from apps.schemas import Message
@@ -53,7 +57,8 @@ from apps.schemas import (
     SSEResponse,
     PartData,
     SSEPartChunk,
-    SSEImageChunk
+    SSEImageChunk,
+    SSESuggestedQuestions
 )
 
 
@@ -67,7 +72,8 @@ async def geometry_stream_generator(
         current_user: User,
         redis_client,
         combinde_query,
-        task: Tasks
+        task: Tasks,
+        dify_http: Optional[httpx.AsyncClient] = None
 ):
     # 初始化一个内存中的助手消息对象
     assistant_message = Message(
@@ -78,16 +84,24 @@ async def geometry_stream_generator(
         metadata={},
         status="in_progress"
     )
+    # 流式期间的Redis写入经缓冲合并，done/failed 时强制落盘
+    message_buffer = MessageWriteBuffer(
+        user_id=current_user.user_id, task_id=request.task_id, task_type=request.task_type,
+        conversation_id=request.conversation_id, redis_client=redis_client
+    )
+    suggestions_task = None
+    geometry_task = None
     try:
+        # 0. 读取本轮之前的对话：没有 Dify 会话也没有历史时才是首轮，只有首轮可以使用建模缓存
+        prior_history = []
+        if not task.dify_conversation_id:
+            prior_history = await _load_prior_history(current_user.user_id, request, redis_client)
+        first_turn = not task.dify_conversation_id and not prior_history
+
         # 1. 立即保存初始的 "in_progress" 消息
-        await save_or_update_message_in_redis(
-            user_id=current_user.user_id, task_id=request.task_id, task_type=request.task_type,
-            conversation_id=request.conversation_id, message=assistant_message, redis_client=redis_client
-        )
+        await message_buffer.save(assistant_message, force=True)
         # 2. 发送会话和任务信息
-        conversation_info_data = SSEConversationInfo(conversation_id=request.conversation_id, task_id=str(request.task_id))
-        sse_conv_info = f'event: conversation_info\ndata: {conversation_info_data.model_dump_json()}\n\n'
-        yield sse_conv_info
+        yield sse.conversation_info(request.conversation_id, request.task_id)
 
         # markdownsign ="```"
         # yield f'event: text_chunk\ndata: {SSETextChunk(text=markdownsign).model_dump_json()}\n\n'
@@ -108,17 +122,28 @@ async def geometry_stream_generator(
 
 
 
-        # 3. 连接dify chat-messsage, 处理流式回复
+        # 3. 相同请求命中缓存时直接回放答案和建模文件，否则连接dify chat-messsage, 处理流式回复
+        base_dir = Path(settings.DIRECTORY) if settings.DIRECTORY else Path("files")
+        task_dir = base_dir / str(request.conversation_id) / str(request.task_id)
+        cache_key = geometry_cache_key(combinde_query)
+        started_at = time.time()
+        cached = None
+        if first_turn and not request.no_cache:
+            cached = await replay_geometry_cache(redis_client, cache_key, task.task_id, task_dir)
+
         client = DifyClient(
             api_key=settings.DIFY_API_KEY,
             base_url=settings.DIFY_API_BASE_URL,
             task_id=request.task_id,
-            task_instance = task
+            task_instance = task,
+            http_client=dify_http
             )
         
+        # 首轮命中缓存时没有建立 Dify 会话；之后的轮次带上此前的对话新建会话，Dify 仍能获得上下文
+        dify_query = _with_history_context(prior_history, combinde_query) if prior_history else combinde_query
         dify_request = MessageRequest(
             inputs={},
-            query=combinde_query,
+            query=dify_query,
             response_mode= "streaming",
             conversation_id=task.dify_conversation_id,
             #files= [],
@@ -127,7 +152,8 @@ async def geometry_stream_generator(
 
         
         full_answer = []
-        async for chunk in client.chat_stream(dify_request):
+        answer_stream = _replay_answer(cached["answer"]) if cached else client.chat_stream(dify_request)
+        async for chunk in answer_stream:
             
             # 关键：将字符串中的 \n 转义符替换为真正的换行控制字符
             formatted_chunk = chunk.replace("\\n", "\n")
@@ -135,22 +161,20 @@ async def geometry_stream_generator(
             assistant_message.content += chunk
             assistant_message.timestamp = datetime.now()
 
-            text_chunk_data = SSETextChunk(text=formatted_chunk)
-            sse_chunk = f'event: text_chunk\ndata: {text_chunk_data.model_dump_json()}\n\n'
-            
-            yield sse_chunk
-            await save_or_update_message_in_redis(
-                user_id=current_user.user_id, task_id=request.task_id, task_type=request.task_type,
-                conversation_id=request.conversation_id, message=assistant_message, redis_client=redis_client
-            )
+            yield sse.text_chunk(formatted_chunk)
+            await message_buffer.save(assistant_message)
 
             #await asyncio.sleep(0.05)
             full_answer.append(chunk)
 
         # markdownsign ="```"
         # yield f'event: text_chunk\ndata: {SSETextChunk(text=markdownsign).model_dump_json()}\n\n'
-        # 获取建议问题
-        suggested_questions = await client.Next_Suggested_Questions()
+        # 结束阶段：建议问题与建模结果查询同时发出，预览图在等待建议问题期间推送（缓存回放时没有 Dify 消息，不获取建议问题）
+        if not cached:
+            suggestions_task = asyncio.create_task(client.Next_Suggested_Questions())
+        geometry_task = asyncio.ensure_future(GeometryResults.get_or_none(task_id=task.task_id))
+        suggestions_started = asyncio.get_running_loop().time()
+        suggestions_deadline = suggestions_started + settings.SUGGESTION_TIMEOUT
 
 
 
@@ -183,7 +207,7 @@ async def geometry_stream_generator(
             #image_parts_for_redis.append({"type": "image", "imageUrl": image_url, "fileName": imgage_file_name, "altText": "几何建模预览图"})
 
         # 4. 发送包含完整元数据的结束消息
-        geometry_result = await GeometryResults.get_or_none(task_id=task.task_id)
+        geometry_result = await geometry_task
         if geometry_result:
             final_metadata = GenerationMetadata(
                     cad_file="model.step",
@@ -206,16 +230,10 @@ async def geometry_stream_generator(
             assistant_message.parts.append(image_part)
             assistant_message.timestamp = datetime.now()
 
-            image_chunk_data = SSEImageChunk(imageUrl=image_url, fileName=image_file_name, altText="几何建模预览图")
             print("几何建模预览图: ",image_url)
-            yield f'event: image_chunk\ndata: {image_chunk_data.model_dump_json()}\n\n'
-
-            await save_or_update_message_in_redis(
-                user_id=current_user.user_id, task_id=request.task_id, task_type=request.task_type,
-                conversation_id=request.conversation_id, message=assistant_message, redis_client=redis_client
-            )
+            yield sse.image_chunk(image_url, image_file_name, "几何建模预览图")
 
-            await asyncio.sleep(0.1)
+            await message_buffer.save(assistant_message)
 
         else:
             final_metadata = GenerationMetadata(
@@ -227,6 +245,16 @@ async def geometry_stream_generator(
 
         assistant_message.metadata = final_metadata.model_dump()
 
+        # 建议问题只等待剩余的时间预算，超时则在 message_end 之后补发
+        suggested_questions = None
+        try:
+            if suggestions_task:
+                suggested_questions = await asyncio.wait_for(
+                    asyncio.shield(suggestions_task),
+                    max(suggestions_deadline - asyncio.get_running_loop().time(), 0)
+                )
+        except asyncio.TimeoutError:
+            print("建议问题尚未返回，将在 message_end 之后补发")
 
         final_response_data = SSEResponse(
             answer=''.join(full_answer),
@@ -234,21 +262,41 @@ async def geometry_stream_generator(
             metadata=final_metadata
         )
         
-        sse_final = f'event: message_end\ndata: {final_response_data.model_dump_json()}\n\n'
-        yield sse_final
+        yield sse.model_event("message_end", final_response_data)
 
 
         # 6. 保存结构化的助手消息到Redis,最后一次更新Redis，状态为 "done"
         assistant_message.status = "done"
         assistant_message.timestamp = datetime.now()
-        await save_or_update_message_in_redis(
-            user_id=current_user.user_id, task_id=request.task_id, task_type=request.task_type,
-            conversation_id=request.conversation_id, message=assistant_message, redis_client=redis_client
-        )
+        await message_buffer.save(assistant_message)
 
         # 7. 数据库操作，保存任务状态，建模结果
         task.status = "done"
         await task.save()
+
+        # 8. 缓存本次建模结果（仅首轮且本轮重新生成了模型文件时）
+        if first_turn and not cached:
+            try:
+                await store_geometry_cache(redis_client, cache_key, ''.join(full_answer), task_dir, since=started_at)
+            except Exception as e:
+                print(f"保存几何建模缓存失败: {e}")
+
+        # 9. 补发迟到的建议问题。
+        # 补发事件只能写在同一条事件流里，流必须等到建议问题返回才能结束；此时消息与任务状态均已保存，
+        # 前端收到 message_end 即可展示完整结果，等待的上限从发出请求时算起，不超过 SUGGESTION_LATE_TIMEOUT
+        if suggestions_task and suggested_questions is None:
+            try:
+                late_questions = await asyncio.wait_for(
+                    suggestions_task,
+                    max(suggestions_started + settings.SUGGESTION_LATE_TIMEOUT - asyncio.get_running_loop().time(), 0)
+                )
+                if late_questions:
+                    yield sse.model_event(
+                        "suggested_questions",
+                        SSESuggestedQuestions(suggested_questions=late_questions)
+                    )
+            except asyncio.TimeoutError:
+                print("建议问题获取超时，已放弃")
         
         # 保存几何建模在mcp中进行
         # geometry_result = await GeometryResults.get_or_none(task_id=task.task_id)
@@ -279,16 +327,72 @@ async def geometry_stream_generator(
         assistant_message.content += f"\n\n**任务执行出错**: {e}"
         assistant_message.status = "failed"
         assistant_message.timestamp = datetime.now()
-        await save_or_update_message_in_redis(
-            user_id=current_user.user_id, task_id=request.task_id, task_type=request.task_type,
-            conversation_id=request.conversation_id, message=assistant_message, redis_client=redis_client
-        )
+        await message_buffer.save(assistant_message)
 
         # 向客户端发送错误事件
         error_data = json.dumps({"error": "An error occurred during task execution."})
         yield f'event: error\ndata: {error_data}\n\n'
+    finally:
+        if suggestions_task and not suggestions_task.done():
+            suggestions_task.cancel()
+        if geometry_task and not geometry_task.done():
+            geometry_task.cancel()
+        message_buffer.close()
     
 
+async def _load_prior_history(user_id, request: TaskExecuteRequest, redis_client) -> List[Dict[str, Any]]:
+    """读取本轮用户消息之前的最近若干条对话（按时间顺序），未启用 Redis 时返回空列表"""
+    if not (settings.REDIS_AVAILABLE and redis_client):
+        return []
+    page = await get_messages_page(
+        user_id, request.task_id, redis_client,
+        limit=settings.GEOMETRY_CONTEXT_MESSAGES + 1, fields=["role", "content"]
+    )
+    messages = page["messages"]
+    # 最新一条是 execute_task 刚保存的本轮用户消息
+    if messages and messages[0].get("role") == "user" and messages[0].get("content") == request.query:
+        messages = messages[1:]
+    return list(reversed(messages[:settings.GEOMETRY_CONTEXT_MESSAGES]))
+
+
+def _with_history_context(history: List[Dict[str, Any]], query: str) -> str:
+    """把此前的对话拼接到请求前，用于没有 Dify 会话的后续轮次"""
+    lines = ["以下是本任务之前的对话记录，请在此基础上回答当前问题。"]
+    for msg in history:
+        speaker = "用户" if msg.get("role") == "user" else "助手"
+        lines.append(f"{speaker}：{msg.get('content') or ''}")
+    lines.append(f"\n当前问题：{query}")
+    return "\n".join(lines)
+
+
+async def _replay_answer(answer: str):
+    """缓存命中时按 Dify 的分片方式回放答案，下游处理保持一致"""
+    yield answer
+
+
+def create_dify_http_client() -> httpx.AsyncClient:
+    """
+    Dify 共享连接池，由 lifespan 创建并挂到 app.state.dify_http，
+    所有请求复用 keep-alive 连接，避免每次请求重新握手。
+    安装了 h2 时启用 HTTP/2（仅对 https 生效）。
+    """
+    try:
+        import h2  # noqa: F401
+        http2 = settings.DIFY_HTTP2
+    except ImportError:
+        http2 = False
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=settings.DIFY_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.DIFY_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=settings.DIFY_KEEPALIVE_EXPIRY,
+        ),
+        # 流式回复在工作流节点之间可能长时间无输出，读超时放宽
+        timeout=httpx.Timeout(settings.DIFY_TIMEOUT, connect=settings.DIFY_CONNECT_TIMEOUT),
+        http2=http2,
+    )
+
+
 # 依赖项：获取Dify API客户端
 async def get_dify_client():
     async with httpx.AsyncClient(base_url=settings.DIFY_API_BASE_URL) as client:
@@ -298,9 +402,20 @@ async def get_dify_client():
         })
         yield client
 
+# 默认路径下需要解析 JSON 的 Dify 事件，其余事件（ping、node_*、workflow_* 等）直接跳过
+DIFY_MATERIALIZED_EVENTS = {"message", "error"}
+
+
 # dift 客户端
 class DifyClient:
-    def __init__(self,api_key: str, base_url: str, task_id: int, task_instance: "Tasks"):
+    def __init__(
+            self,
+            api_key: str,
+            base_url: str,
+            task_id: int,
+            task_instance: "Tasks",
+            http_client: Optional[httpx.AsyncClient] = None
+    ):
         self.api_key = api_key
         self.base_url = base_url
         self.task_id = task_id
@@ -311,56 +426,78 @@ class DifyClient:
             'Content-Type': 'application/json',
             'Accept': '*/*',
             'Host': 'localhost',
-            'Connection': 'keep-alive'
         }
-
-    async def chat_stream(self, request: MessageRequest):
-        """发送聊天请求并处理流式响应"""
+        # 未传入共享连接池时（如脚本调用）临时创建，用完关闭
+        self.http_client = http_client
+
+    @asynccontextmanager
+    async def _client(self):
+        if self.http_client is not None:
+            yield self.http_client
+            return
+        async with create_dify_http_client() as client:
+            yield client
+
+    async def chat_stream(self, request: MessageRequest, typed_chunks: bool = False):
+        """
+        发送聊天请求并处理流式响应。
+        默认只解析 message 事件并产出回答文本，其余事件按 event 字段跳过、不做 JSON 解析；
+        typed_chunks=True 时每个事件都经 _parse_chunk 解析为 StreamChunk 模型并产出（较慢）。
+        """
 
         url = f"{self.base_url}/v1/chat-messages"
         payload = json.dumps(request.model_dump())
-        FLAG = True
-
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, data=payload, headers=self.headers) as response:
-                #print("响应状态码:", response.status)  # Debug log
-                if response.status != 200:
-                    error_detail = await response.text()
-                    raise HTTPException(
-                        status_code=response.status, 
-                        detail=f"Dify API error: {error_detail}"
-                    )
-                # 处理流式响应
-                async for line in response.content:
-                    
-                    # 处理SSE格式 (data: ...)
-                    line = line.decode('utf-8').strip()
-                    if not line:
-                        continue 
-                    if line.startswith('data: '):
-                        data_str = line[len('data: '):]
-
-
-                    try:
-                        data = json.loads(data_str)
-                        # 根据event类型解析为对应的模型
-                        #chunk = self._parse_chunk(data)
-                        if FLAG:
-                            FLAG = False
-
-                            await self.add_conversation_id(data["conversation_id"])
-                            self.last_message_id = data["message_id"]
-                            FLAG = False
-
-                        if data["event"] == "message":
-                            if "answer" in data:
-                                #text_chunk = SSETextChunk(event="text_chunk", text=chunk.answer)
-                                #sse_chunk = f'event: text_chunk\ndata: {text_chunk.model_dump_json()}\n\n'
-                                yield data["answer"]
-                    except Exception as e:
-                         #yield f"event: error\ndata: {'message': f'解析响应失败: {str(e)}'}\n\n"
-                        yield f"解析响应失败: {str(e)}"
-                    #await asyncio.sleep(0.05)
+        ids_pending = True  # 会话ID、消息ID取自第一个携带它们的事件
+        decoder = sse.SSEDecoder()
+        # 对话请求不是幂等操作，只经过熔断器：Dify 不可用时快速失败
+        breaker = get_circuit_breaker("dify")
+        breaker.before_call()
+
+        async with self._client() as client:
+            try:
+                async with client.stream("POST", url, content=payload, headers=self.headers) as response:
+                    #print("响应状态码:", response.status_code)  # Debug log
+                    if response.status_code >= 500:
+                        breaker.record_failure()
+                    else:
+                        breaker.record_success()
+                    if response.status_code != 200:
+                        error_detail = (await response.aread()).decode("utf-8", "replace")
+                        raise HTTPException(
+                            status_code=response.status_code, 
+                            detail=f"Dify API error: {error_detail}"
+                        )
+                    # 处理流式响应
+                    async for raw in response.aiter_bytes():
+                        for _, data_bytes in decoder.feed(raw):
+                            event_type = sse.peek_event_type(data_bytes)
+                            if not typed_chunks and event_type not in DIFY_MATERIALIZED_EVENTS and not (
+                                ids_pending and event_type != "ping"
+                            ):
+                                continue
+
+                            try:
+                                data = sse.loads(data_bytes)
+                                if ids_pending and "conversation_id" in data:
+                                    ids_pending = False
+                                    await self.add_conversation_id(data["conversation_id"])
+                                    self.last_message_id = data.get("message_id")
+
+                                if typed_chunks:
+                                    yield self._parse_chunk(data)
+                                elif event_type == "message":
+                                    if "answer" in data:
+                                        yield data["answer"]
+                                elif event_type == "error":
+                                    print(f"Dify 返回错误事件: {data.get('message')}")
+                            except Exception as e:
+                                #yield f"event: error\ndata: {'message': f'解析响应失败: {str(e)}'}\n\n"
+                                yield f"解析响应失败: {str(e)}"
+            except httpx.TransportError:
+                # 连接失败、超时等网络错误计入熔断
+                breaker.record_failure()
+                raise
+
     async def add_conversation_id(self,conversation_id: str):
         
         self.task_instance.dify_conversation_id = conversation_id  # 更新任务的Dify会话ID
@@ -372,15 +509,21 @@ class DifyClient:
         url = f"{self.base_url}/v1/messages/{self.last_message_id}/suggested?user=abc-123"
         print("建议问题URL:", url)  # Debug log
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    url, 
-                    headers={
-                        'Authorization': self.headers["Authorization"],
-                        'Content-Type': 'application/json',
-
-                    }
-                )
+            async with self._client() as client:
+                async def request():
+                    response = await client.get(
+                        url, 
+                        headers={
+                            'Authorization': self.headers["Authorization"],
+                            'Content-Type': 'application/json',
+
+                        }
+                    )
+                    response.raise_for_status()
+                    return response
+
+                # 幂等请求：失败时退避重试，慢请求发对冲
+                response = await call_idempotent(get_circuit_breaker("dify"), request)
                 print("建议响应:", response)  # Debug log
                 print("建议响应:", response.json()["data"])  # Debug log
                 return response.json()
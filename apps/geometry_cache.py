@@ -0,0 +1,187 @@
+from typing import Optional, Dict, Any
+from pathlib import Path
+from time import time
+import asyncio
+import hashlib
+import json
+import os
+import re
+import shutil
+import unicodedata
+import uuid
+
+import redis.asyncio as aioredis
+
+from database.models import GeometryResults
+from config import settings
+
+
+# 几何建模结果缓存：相同（归一化后）的建模请求直接回放答案与建模文件，不再调用 Dify 和 run_cadquery。
+# - 元信息存 Redis 哈希 geometry_cache:{key}，带 TTL
+# - 建模文件存 DIRECTORY/_geometry_cache/{key}/
+# - ZSET geometry_cache_lru 记录最近访问时间，超出 GEOMETRY_CACHE_MAX_ENTRIES 时淘汰最久未用的
+# 只在任务的首轮对话（没有 Dify 会话、没有历史消息）读写缓存：后续轮次的回答依赖会话上下文，
+# 且缓存的答案会回放给其他用户的任务，答案中引用了本任务文件路径时不缓存。
+
+GEOMETRY_ARTIFACTS = ("script.py", "model.step", "model.stl", "Oblique_View.png")
+GEOMETRY_CACHE_LRU_KEY = "geometry_cache_lru"
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_query(query: str) -> str:
+    """全半角统一、小写、合并空白"""
+    query = unicodedata.normalize("NFKC", query or "").lower()
+    return _WHITESPACE.sub(" ", query).strip()
+
+
+def geometry_cache_key(query: str, context: Optional[str] = None) -> str:
+    """缓存键：归一化后的请求 + 上下文（首轮对话没有上下文）"""
+    raw = normalize_query(query) + "\0" + (context or "")
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+
+
+def get_geometry_cache_key(key: str) -> str:
+    """生成缓存元信息的Redis键名"""
+    return f"geometry_cache:{key}"
+
+
+def get_geometry_cache_dir(key: str) -> Path:
+    base_dir = Path(settings.DIRECTORY) if settings.DIRECTORY else Path("files")
+    return base_dir / "_geometry_cache" / key
+
+
+def _copy_artifacts(src_dir: Path, dst_dir: Path, names) -> list:
+    dst_dir.mkdir(parents=True, exist_ok=True)
+    copied = []
+    for name in names:
+        src = src_dir / name
+        if src.is_file():
+            shutil.copy2(src, dst_dir / name)
+            copied.append(name)
+    return copied
+
+
+def _publish_cache_dir(task_dir: Path, cache_dir: Path) -> list:
+    """先复制到临时目录再整体改名，避免并发写入时读到不完整的缓存"""
+    tmp_dir = cache_dir.with_name(f".{cache_dir.name}.{uuid.uuid4().hex[:8]}")
+    copied = _copy_artifacts(task_dir, tmp_dir, GEOMETRY_ARTIFACTS)
+    try:
+        if cache_dir.exists():
+            shutil.rmtree(cache_dir, ignore_errors=True)
+        os.replace(tmp_dir, cache_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return copied
+
+
+async def _evict(redis_client: aioredis.Redis, keys):
+    """删除缓存条目及其文件"""
+    if not keys:
+        return
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.zrem(GEOMETRY_CACHE_LRU_KEY, *keys)
+        pipe.delete(*[get_geometry_cache_key(key) for key in keys])
+        await pipe.execute()
+    for key in keys:
+        await asyncio.to_thread(shutil.rmtree, get_geometry_cache_dir(key), True)
+
+
+async def replay_geometry_cache(
+        redis_client: aioredis.Redis,
+        key: str,
+        task_id: int,
+        task_dir: Path
+) -> Optional[Dict[str, Any]]:
+    """
+    命中时把缓存的建模文件复制到任务目录并写入建模结果，返回缓存的答案信息；未命中返回 None。
+    """
+    if not (settings.GEOMETRY_CACHE_ENABLED and settings.REDIS_AVAILABLE and redis_client):
+        return None
+    entry = await redis_client.hgetall(get_geometry_cache_key(key))
+    if not entry:
+        # 元信息已过期，顺带清理残留文件
+        if await redis_client.zscore(GEOMETRY_CACHE_LRU_KEY, key) is not None:
+            await _evict(redis_client, [key])
+        return None
+
+    artifacts = json.loads(entry.get("artifacts") or "[]")
+    cache_dir = get_geometry_cache_dir(key)
+    copied = await asyncio.to_thread(_copy_artifacts, cache_dir, task_dir, artifacts)
+    if len(copied) != len(artifacts):
+        print(f"几何建模缓存文件缺失，已失效: {key}")
+        await _evict(redis_client, [key])
+        return None
+
+    # 访问后续期（TTL 按最近访问计算，与 LRU 一致）
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.zadd(GEOMETRY_CACHE_LRU_KEY, {key: time()})
+        pipe.expire(get_geometry_cache_key(key), settings.GEOMETRY_CACHE_TTL)
+        await pipe.execute()
+    update_data = {
+        "cad_file_path": str(task_dir / "model.step"),
+        "code_file_path": str(task_dir / "script.py"),
+        "preview_image_path": str(task_dir / "Oblique_View.png"),
+    }
+    geometry_result = await GeometryResults.get_or_none(task_id=task_id)
+    if geometry_result:
+        await geometry_result.update_from_dict(update_data).save()
+    else:
+        await GeometryResults.create(task_id=task_id, **update_data)
+    print(f"命中几何建模缓存: {key}")
+    return {"answer": entry.get("answer", ""), "artifacts": artifacts}
+
+
+def references_task_artifacts(answer: str, task_dir: Path) -> bool:
+    """答案中是否出现了本任务目录（绝对路径或 会话ID/任务ID 片段），这类答案回放到其他任务时路径是错的"""
+    conversation_id, task_id = task_dir.parent.name, task_dir.name
+    markers = {
+        str(task_dir),
+        task_dir.as_posix(),
+        str(task_dir.resolve()),
+        f"{conversation_id}/{task_id}",
+        f"{conversation_id}\\{task_id}",
+    }
+    return any(marker in answer for marker in markers)
+
+
+async def store_geometry_cache(
+        redis_client: aioredis.Redis,
+        key: str,
+        answer: str,
+        task_dir: Path,
+        since: float
+):
+    """
+    保存本次建模的答案与文件；since 之后没有重新生成模型文件时不缓存（避免缓存上一轮的结果），
+    答案引用了本任务文件路径时不缓存。调用方只在首轮对话时调用。
+    """
+    if not (settings.GEOMETRY_CACHE_ENABLED and settings.REDIS_AVAILABLE and redis_client):
+        return
+    if references_task_artifacts(answer, task_dir):
+        print("建模答案引用了任务文件路径，不缓存")
+        return
+    model_step = task_dir / "model.step"
+    if not model_step.is_file() or model_step.stat().st_mtime < since:
+        return
+
+    artifacts = await asyncio.to_thread(_publish_cache_dir, task_dir, get_geometry_cache_dir(key))
+    now = time()
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(get_geometry_cache_key(key), mapping={
+            "answer": answer,
+            "artifacts": json.dumps(artifacts),
+            "created_at": now,
+        })
+        pipe.expire(get_geometry_cache_key(key), settings.GEOMETRY_CACHE_TTL)
+        pipe.zadd(GEOMETRY_CACHE_LRU_KEY, {key: now})
+        pipe.zcard(GEOMETRY_CACHE_LRU_KEY)
+        results = await pipe.execute()
+
+    # 淘汰：已过期的条目，以及超出容量时最久未访问的条目
+    expired = await redis_client.zrangebyscore(GEOMETRY_CACHE_LRU_KEY, "-inf", now - settings.GEOMETRY_CACHE_TTL)
+    overflow = results[-1] - len(expired) - settings.GEOMETRY_CACHE_MAX_ENTRIES
+    if overflow > 0:
+        oldest = await redis_client.zrange(GEOMETRY_CACHE_LRU_KEY, len(expired), len(expired) + overflow - 1)
+        expired.extend(oldest)
+    await _evict(redis_client, [k for k in expired if k != key])
@@ -19,15 +19,21 @@ import websockets
 
 import asyncio
 
-import aiofiles
 from pathlib import Path
 
 from config import settings
+from core import sse
 from core.authentication import authenticate
+from core.resilience import CircuitOpenError, HealthProbe, call_idempotent, call_once, get_circuit_breaker
+from core import control_file
+from core.images import THUMBNAIL_DIR, create_thumbnail, is_image_complete
+from core.tail import LogTailer
+from core.watcher import file_watch_service, watch_file
 from core.authentication import User
 from database.models import Tasks
 from database.models import OptimizationResults
-from apps.chat import  save_or_update_message_in_redis
+from apps.chat import MessageWriteBuffer
+from apps.scheduler import OptimizeSlot
 from apps.schemas import Message
 from apps.schemas import (
     OptimizeRequest,
@@ -43,6 +49,7 @@ from apps.schemas import (
     SSEConversationInfo,
     SSETextChunk,
     SSEResponse,
+    SSEQueuePosition,
     PartData,
     SSEPartChunk,
     SSEImageChunk
@@ -57,7 +64,8 @@ async def optimize_stream_generator(
         current_user: User,
         redis_client,
         combinde_query,
-        task: Tasks
+        task: Tasks,
+        algorithm_client: Optional["AlgorithmClient"] = None
 ):
 
             assistant_message = Message(
@@ -71,24 +79,21 @@ async def optimize_stream_generator(
             # 初始化状态标识
             task_terminate_event = asyncio.Event()  # 任务终止信号（用于两个并行任务通信）
             control_monitor_result = {"success": None, "message": ""}  # 控制监听结果存储
+            # 日志逐行写入Redis时经缓冲合并，done/failed 时强制落盘
+            message_buffer = MessageWriteBuffer(
+                user_id=current_user.user_id, task_id=request.task_id, task_type=request.task_type,
+                conversation_id=request.conversation_id, redis_client=redis_client
+            )
+            # 算法执行槽位，结束或出错时释放
+            slot = OptimizeSlot(redis_client, request.task_id)
+            # 等待任务启动并监听控制文件的后台任务，结束或出错时取消
+            status_monitor_task = None
             try:
                  # 1. 立即保存初始的 "in_progress" 消息,
-                await save_or_update_message_in_redis(
-                    user_id=current_user.user_id,
-                    task_id=request.task_id, 
-                    task_type=request.task_type,
-                    conversation_id=request.conversation_id, 
-                    message=assistant_message, 
-                    redis_client=redis_client
-                )
+                await message_buffer.save(assistant_message, force=True)
 
                 # 2. 发送会话和任务信息
-                conversation_info_data = SSEConversationInfo(
-                    conversation_id=request.conversation_id, 
-                    task_id=str(request.task_id)
-                )
-                sse_conv_info = f'event: conversation_info\ndata: {conversation_info_data.model_dump_json()}\n\n'
-                yield sse_conv_info
+                yield sse.conversation_info(request.conversation_id, request.task_id)
 
                 # # 3. 模拟流式发送文本块并更新Redis
                 # FILE_PATH = r"C:\Users\dell\Projects\CAutoD\cautod_fastapi\files\846ac6da-3e33-419e-ba9f-de37a2a89df0\426\backend_log.txt"
@@ -140,13 +145,24 @@ async def optimize_stream_generator(
                         "model_path": model_path,
                     }
                 )
-                algorithm_client = AlgorithmClient(base_url=settings.OPTIMIZE_API_URL)
-                # 检查算法服务健康状态
-                health_status = await algorithm_client.check_health()
-                if health_status.status != "healthy":
+                # 排队等待算法执行槽位，期间推送排队位置
+                async for position in slot.wait():
+                    print(f"任务 {request.task_id} 排队中，位置: {position}")
+                    yield sse.model_event(
+                        "queue_position",
+                        SSEQueuePosition(task_id=str(request.task_id), position=position)
+                    )
+                task.status = "running"
+                await task.save()
+
+                # 复用 lifespan 中创建的共享客户端（连接池保持热连接），未提供时临时创建
+                if algorithm_client is None:
+                    algorithm_client = AlgorithmClient(base_url=settings.OPTIMIZE_API_URL)
+                # 检查算法服务健康状态（读取后台探测的缓存结果，不在请求路径上等待）
+                if not await algorithm_client.health.is_healthy():
                     raise HTTPException(
                         status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-                        detail="Algorithm service is not healthy."
+                        detail=f"Algorithm service is not healthy. {algorithm_client.health.detail}"
                     )
                 
 
@@ -163,9 +179,9 @@ async def optimize_stream_generator(
                     task_terminate_event = task_terminate_event,
 
                 )
-                # 订阅任务启动通知
+                # 订阅任务启动通知，启动后开始监听控制文件
                 status_monitor_task = asyncio.create_task(
-                      monitor_callback()
+                      algorithm_client.subscribe_to_task_start(task.task_id, monitor_callback)
                 )
                 print("出来了吗")
 
@@ -226,7 +242,7 @@ async def optimize_stream_generator(
                         task_terminate_event,
                         assistant_message,
                         current_user,
-                        redis_client,
+                        message_buffer,
                         queue):
                     """消费日志监控生成器，将结果放入队列"""
                     try:
@@ -238,15 +254,12 @@ async def optimize_stream_generator(
                             task_terminate_event,
                             assistant_message,
                             current_user,
-                            redis_client
+                            message_buffer
                         ):
                             # 将生成的chunk放入队列
                             print("日志sse_chunk: ", sse_chunk)
                             await queue.put(sse_chunk)
-                            
-                            # 检查是否需要终止
-                            if task_terminate_event.is_set():
-                                break
+                            # 终止后不在这里中断：日志监控会自行结束，并补读剩余内容（包括没有换行的末行）
                     except Exception as e:
                         print(f"图片生成器消费出错: {str(e)}")
                         # 可以放入错误信息到队列
@@ -265,7 +278,7 @@ async def optimize_stream_generator(
                         task_terminate_event,
                         assistant_message,
                         current_user,
-                        redis_client,
+                        message_buffer,
                         queue
                     )
                 )
@@ -276,19 +289,22 @@ async def optimize_stream_generator(
                     if chunk:
                         yield chunk
 
-                # 取消后台任务
+                # 取消后台任务；日志监控先等待其补读剩余内容，再推送队列中尚未发送的块
                 image_monitor_task.cancel()
+                await asyncio.wait({log_monitor_task}, timeout=settings.LOG_TAIL_DRAIN_TIMEOUT)
                 log_monitor_task.cancel()
+                while not queue.empty():
+                    chunk = queue.get_nowait()
+                    if chunk:
+                        yield chunk
 
                 print("full_answer: ", state)
 
 
 
-                # 确保状态监控任务完成
-                # if not status_monitor_task.done():
-                #     await status_monitor_task
+                # 状态监控任务在 finally 中取消（未收到启动通知时也不会在任务结束后再开始监听）
                 print("执行这个close了吗")
-                await algorithm_client.close()  # 关闭算法客户端连接
+                await algorithm_client.close()  # 关闭算法客户端连接（共享客户端不会被关闭）
 
                 # 9. 采用新的图片流式方案并更新Redis
                 base_dir = Path(settings.STATIC_URL) if settings.STATIC_URL else Path("/files")
@@ -316,13 +332,9 @@ async def optimize_stream_generator(
 
                     # 使用 SSEImageChunk 发送图片信息
                     print("设计优化图片：", image_url)
-                    image_chunk_data = SSEImageChunk(imageUrl=image_url, fileName=image_file_name, altText=img_data["alt"])
-                    yield f'event: image_chunk\ndata: {image_chunk_data.model_dump_json()}\n\n'
+                    yield sse.image_chunk(image_url, image_file_name, img_data["alt"])
 
-                    await save_or_update_message_in_redis(
-                        user_id=current_user.user_id, task_id=request.task_id, task_type=request.task_type,
-                        conversation_id=request.conversation_id, message=assistant_message, redis_client=redis_client
-                    )
+                    await message_buffer.save(assistant_message)
 
                     await asyncio.sleep(0.1) # 恢复延迟
                         
@@ -340,16 +352,12 @@ async def optimize_stream_generator(
                     metadata=final_metadata
                 )
                 
-                sse_final = f'event: message_end\ndata: {final_response_data.model_dump_json()}\n\n'
-                yield sse_final
+                yield sse.model_event("message_end", final_response_data)
 
                  # 11. 最后一次更新Redis，状态为 "done"
                 assistant_message.status = "done"
                 assistant_message.timestamp = datetime.now()
-                await save_or_update_message_in_redis(
-                    user_id=current_user.user_id, task_id=request.task_id, task_type=request.task_type,
-                    conversation_id=request.conversation_id, message=assistant_message, redis_client=redis_client
-                )
+                await message_buffer.save(assistant_message)
 
                 # 12. 数据库操作，保存任务状态，优化结果
                 task.status = "done"
@@ -379,13 +387,19 @@ async def optimize_stream_generator(
                 assistant_message.content += f"\n\n**任务执行出错**: {e}"
                 assistant_message.status = "failed"
                 assistant_message.timestamp = datetime.now()
-                await save_or_update_message_in_redis(
-                    user_id=current_user.user_id, task_id=request.task_id, task_type=request.task_type,
-                    conversation_id=request.conversation_id, message=assistant_message, redis_client=redis_client
-                )
+                await message_buffer.save(assistant_message)
 
                 error_data = json.dumps({"error": "An error occurred during task execution."})
                 yield f'event: error\ndata: {error_data}\n\n'
+            finally:
+                if status_monitor_task and not status_monitor_task.done():
+                    status_monitor_task.cancel()
+                    try:
+                        await status_monitor_task
+                    except asyncio.CancelledError:
+                        pass
+                await slot.release()
+                message_buffer.close()
 
 
 
@@ -434,26 +448,145 @@ async def optimize_design(
     return optimization_stream()
 
 
+# 视为“任务已启动”的状态：running，以及直接跳到的终态（避免等待者一直挂起）
+TASK_STARTED_STATUSES = {"running", "completed", "done", "failed", "error"}
+
+
+class TaskStatusSubscriber:
+    """
+    任务启动通知。算法服务按任务推送状态：连接 {ws_base}{ALGORITHM_EVENTS_PATH}/{task_id}，
+    任务启动时收到 {"status": "running"}（消息中不带 task_id，由连接区分任务）。
+    - 同一任务的多个等待者共用一条连接，最后一个等待者退出时关闭；断开后按退避重连
+    - 连接空闲时每 ALGORITHM_WS_PING_INTERVAL 秒发送一次 ping 保活
+    - 等待开始时立即查询一次状态，覆盖连接建立前已经启动的任务；连接未建立或断开期间
+      按 ALGORITHM_STATUS_POLL_INTERVAL 轮询状态，推送与轮询先到者为准
+    """
+    def __init__(self, client: "AlgorithmClient"):
+        self.client = client
+        ws_protocol = "wss" if client.base_url.startswith("https") else "ws"
+        self.base_url = client.base_url.replace("http", ws_protocol, 1).rstrip("/") + settings.ALGORITHM_EVENTS_PATH
+        self._waiters: Dict[str, List[asyncio.Future]] = {}
+        self._listeners: Dict[str, asyncio.Task] = {}
+        self._connected: Set[str] = set()
+
+    def _resolve(self, task_id: str, data: Dict[str, Any]):
+        for future in self._waiters.get(task_id, []):
+            if not future.done():
+                future.set_result(data)
+
+    async def _listen(self, task_id: str):
+        """维持任务的推送连接，直到收到启动通知"""
+        url = f"{self.base_url}/{task_id}"
+        delay = settings.RETRY_BASE_DELAY
+        while task_id in self._waiters:
+            try:
+                async with websockets.connect(url) as websocket:
+                    print(f"已订阅任务状态推送: {url}")
+                    self._connected.add(task_id)
+                    delay = settings.RETRY_BASE_DELAY
+                    while True:
+                        try:
+                            message = await asyncio.wait_for(websocket.recv(), settings.ALGORITHM_WS_PING_INTERVAL)
+                        except asyncio.TimeoutError:
+                            await websocket.send(json.dumps({"type": "ping"}))
+                            continue
+                        try:
+                            data = json.loads(message)
+                        except ValueError:
+                            continue
+                        if isinstance(data, dict) and data.get("status") in TASK_STARTED_STATUSES:
+                            print(f"收到任务状态推送: 任务{task_id} {data.get('status')}")
+                            self._resolve(task_id, data)
+                            return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"任务{task_id}状态推送连接断开: {e}，{delay:.1f} 秒后重连")
+            finally:
+                self._connected.discard(task_id)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, settings.ALGORITHM_WS_RECONNECT_MAX)
+
+    async def _poll(self, task_id: str):
+        """开始时查询一次；推送连接未建立或断开期间持续轮询"""
+        first = True
+        while True:
+            if first or task_id not in self._connected:
+                try:
+                    task_status = await self.client.get_task_status(task_id)
+                    if task_status.status in TASK_STARTED_STATUSES:
+                        self._resolve(task_id, task_status.model_dump())
+                        return
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print(f"查询任务{task_id}状态失败: {e}")
+            first = False
+            await asyncio.sleep(settings.ALGORITHM_STATUS_POLL_INTERVAL)
+
+    async def wait_for_start(self, task_id, timeout: Optional[float] = None) -> Dict[str, Any]:
+        """等待任务启动，返回状态数据；超时抛出 asyncio.TimeoutError"""
+        task_id = str(task_id)
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(task_id, []).append(future)
+        listener = self._listeners.get(task_id)
+        if listener is None or listener.done():
+            self._listeners[task_id] = asyncio.create_task(self._listen(task_id), name=f"task-status-{task_id}")
+        poller = asyncio.create_task(self._poll(task_id))
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            poller.cancel()
+            waiters = self._waiters.get(task_id, [])
+            if future in waiters:
+                waiters.remove(future)
+            if not waiters:
+                self._waiters.pop(task_id, None)
+                listener = self._listeners.pop(task_id, None)
+                if listener and not listener.done():
+                    listener.cancel()
+
+    async def close(self):
+        listeners = list(self._listeners.values())
+        self._listeners.clear()
+        for listener in listeners:
+            listener.cancel()
+        if listeners:
+            await asyncio.gather(*listeners, return_exceptions=True)
+
+
 # 算法服务客户端
 class AlgorithmClient:
+    """
+    shared=True 时为进程内共享的客户端（由 lifespan 创建），close() 不会真正关闭连接池，
+    只有应用关闭时 close(force=True) 才释放。
+    """
     def __init__(self, 
                  base_url: str,
                  timeout: float = 30.0,
-                 max_connections: int = 100
+                 max_connections: Optional[int] = None,
+                 shared: bool = False
     ):
         self.base_url = base_url
         self.timeout = timeout
+        self.shared = shared
         self.client = httpx.AsyncClient(
             base_url=base_url,
             timeout=self.timeout,
-            #limits=httpx.limits(max_connections=max_connections),
-            headers={"Connection": "keep-alive"}
+            limits=httpx.Limits(
+                max_connections=max_connections or settings.ALGORITHM_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.ALGORITHM_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=settings.ALGORITHM_KEEPALIVE_EXPIRY,
+            ),
         )
         print("连接上算法服务端了：",self.client)
         self._is_closed = False
-        self.websocket : Optional[websockets.WebSocketClientProtocol] = None
-        self.websocket_task: Optional[asyncio.Task] = None
+        # 任务启动通知（按任务建立推送连接，同一任务的等待者共用）
+        self.events = TaskStatusSubscriber(self)
         self.status = None
+        # 最近一次健康检查的结果，短时间内复用，不在提交任务的路径上等待
+        self.health_status: Optional[HealthStatus] = None
+        self.health = HealthProbe("algorithm", self._probe_health, max_age=settings.ALGORITHM_HEALTH_TTL)
 
     async def __aenter__(self):
         """支持异步上下文管理器进入"""
@@ -499,11 +632,15 @@ class AlgorithmClient:
         检查算法服务的健康状态。
         返回一个 HealthStatus 实例，包含状态信息。
         """
-        try:
+        async def request():
             response = await self.client.get("/health")
             response.raise_for_status()
+            return response
+
+        try:
+            response = await call_idempotent(get_circuit_breaker("algorithm"), request)
             return HealthStatus(**response.json())
-        except httpx.HTTPError as e:
+        except (httpx.HTTPError, CircuitOpenError) as e:
             raise HTTPException(
                 status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
                 detail=f"Algorithm service is unavailable: {str(e)}"
@@ -511,103 +648,72 @@ class AlgorithmClient:
         
     async def run_algorithm(self, request: AlgorithmRequest) -> TaskStatus:
         """调用算法服务的运行接口"""
-        try:
+        async def submit():
             response = await self.client.post(
                 "/run-algorithm",#"/submit-task",
                 json=request.model_dump(),
             )
             response.raise_for_status()
-            
+            return response
+
+        try:
+            # 提交任务不是幂等操作，只经过熔断器，不重试
+            response = await call_once(get_circuit_breaker("algorithm"), submit)
             return TaskStatus(**response.json())
+        except CircuitOpenError as e:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail=f"Algorithm service is unavailable: {str(e)}"
+            )
         except httpx.HTTPError as e:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail=f"Error running algorithm: {str(e)}"
             )
-    async def check_task_status(self, task_id, callback: Callable):
-        try:
-            while True:
-                response = await self.client.get(
-                    f"/task-status/{task_id}",
-                    timeout=10  # 设置10秒超时
-                )
-                
-                response.raise_for_status()
+    async def get_task_status(self, task_id) -> TaskStatus:
+        """查询一次任务状态"""
+        async def request():
+            response = await self.client.get(
+                f"/task-status/{task_id}",
+                timeout=10  # 设置10秒超时
+            )
+            response.raise_for_status()
+            return response
 
-                data = response.json()
-                try:
-                    taskstatus = TaskStatus(**data)
-                except Exception as e:
-                    raise ValueError(f"服务端返回的数据格式不符合要求: {str(e)}")
-                
-                # 检查任务状态
-                print(f"查询到任务{task_id}状态 {taskstatus.status}")
-                if taskstatus.status == "running":
-                    # 状态为运行中，调用回调函数
-                    await callback()  # 如果回调是异步函数
-                    # 或者：callback(task_status)  # 如果回调是同步函数
-                    break  # 触发回调后退出轮询
-
-                # 等待1秒后再次查询
-                await asyncio.sleep(5)
-        except Exception as e:
-            if response.status_code == 404:
+        try:
+            response = await call_idempotent(get_circuit_breaker("algorithm"), request)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 404:
                 raise ValueError(f"任务ID不存在: {task_id}") from e
-            else:
-                raise ValueError(f"查询失败，HTTP状态码: {response.status_code}") from e
+            raise ValueError(f"查询失败，HTTP状态码: {e.response.status_code}") from e
+        try:
+            return TaskStatus(**response.json())
+        except Exception as e:
+            raise ValueError(f"服务端返回的数据格式不符合要求: {str(e)}")
+
+    async def check_task_status(self, task_id, callback: Callable):
+        """等待任务进入运行状态后调用回调（状态由 WebSocket 推送，断开时轮询，见 TaskStatusSubscriber）"""
+        await self.events.wait_for_start(task_id)
+        await callback()
 
     async def subscribe_to_task_start(self, task_id, callback: Callable):
         """
-        订阅任务启动通知
+        订阅任务启动通知，收到后以通知内容调用回调。
+        超过 ALGORITHM_START_TIMEOUT 未收到通知时仍调用回调（data 为 None），
+        控制文件才是任务结束的依据，不能因为通知丢失而一直不开始监听。
         """
-
-        # 构建WebSocket URL
-        ws_protocol = "wss" if self.base_url.startswith("https") else "ws"
-        base_ws_url = self.base_url.replace("http", ws_protocol, 1).rstrip("/")
-        ws_url = f"{base_ws_url}/ws/{task_id}"
-        print("ws_url: ", ws_url)
         try:
-            # 连接WebSocket
-            async with websockets.connect(ws_url) as websocket:
-                self.websocket = websocket
+            data = await self.events.wait_for_start(task_id, timeout=settings.ALGORITHM_START_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"等待任务启动通知超时: {task_id}，直接开始监听")
+            data = None
+        await callback(data)
 
-            # 等待消息
-            while True:
-                try:
-                    # 接收消息， 设置超时
-                    message = await asyncio.wait_for(self.websocket.recv(), timeout=10) # 10小时超时
-                    data = json.loads(message)
-                    print("收到websocker return:", data)
-
-                    # 处理订阅确认
-                    if data.get("status") == "subscribed" :
-                        print(f"已成功订阅任务通知: 任务{task_id}")
-                    # 处理任务启动通知
-                    elif data.get("status") == "connected":
-                        pass
-                    elif data.get("status") == "running":
-                        print(f"任务已启动: {task_id}")
-                        await callback(data)  # 调用回调函数
-                        break  # 收到启动通知后退出循环
-
-                except asyncio.TimeoutError:
-                    await self.websocket.send(json.dumps({"type": "ping"}))
-                except websockets.exceptions.ConnectionClosed:
-                    print(f"WebSocket连接已关闭: {task_id}")
-                    break
-        except Exception as e:
-            print(f"WebSocket订阅出错: {str(e)}")
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=f"Error subscribing to task notifications: {str(e)}"
-            )
-        
     async def send_parameter(self, model_path: str,param: dict):
         """发送优化参数到算法服务"""
         try:
 
-            with open(rf"{model_path}\parameters.txt", "w", encoding="utf-8") as f:
-                json.dump(param, f)
+            await control_file.awrite_json(os.path.join(model_path, "parameters.txt"), param)
 
             response = await self.client.post(
                 "/sent_parameter",
@@ -625,21 +731,21 @@ class AlgorithmClient:
                 detail=f"Error sending parameters: {str(e)}"
             )
         
-    async def close(self):
-        if self._is_closed:
+    async def _probe_health(self) -> bool:
+        self.health_status = await self.check_health()
+        return self.health_status.status == "healthy"
+
+    async def close(self, force: bool = False):
+        """关闭 HTTP 客户端连接；共享客户端只在 force=True（应用关闭）时关闭"""
+        if self._is_closed or (self.shared and not force):
             return
-        """关闭 HTTP 客户端连接"""
+        self.health.stop()
         print("Closing AlgorithmClient connections...")
         if not self.client.is_closed:
             await self.client.aclose()
 
-        # 关闭WebSocket连接
-        if self.websocket and not self.websocket.closed:
-            await self.websocket.close()
-
-        # 取消WebSocket任务
-        if self.websocket_task and not self.websocket_task.done():
-            self.websocket_task.cancel()
+        # 关闭状态推送的WebSocket连接
+        await self.events.close()
             
         self._is_closed = True
 
@@ -653,40 +759,6 @@ class ControlCommand:
     CSERROR = -1
     PYERROR = -2
 
-# 工具函数：读写文件
-def read_key(file_path, key):
-    """读取文件中指定键的值"""
-    if not os.path.exists(file_path):
-        return None
-    try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            for line in f:
-                line = line.strip()
-                if line.startswith(f"{key}="):
-                    return line.split("=", 1)[1].strip()
-    except Exception as e:
-        print(f"读取键值失败（{key}）：{e}")
-    return None
-
-def write_key(file_path, key, value):
-    """写入键值对到文件"""
-    lines = []
-    if os.path.exists(file_path):
-        with open(file_path, "r", encoding="utf-8") as f:
-            lines = [line.strip() for line in f]
-
-    found = False
-    for i in range(len(lines)):
-        if lines[i].startswith(f"{key}="):
-            lines[i] = f"{key}={value}"
-            found = True
-            break
-    if not found:
-        lines.append(f"{key}={value}")
-
-    with open(file_path, "w", encoding="utf-8") as f:
-        f.write("\n".join(lines))
-
 class ControlFileMonitor:
     """控制文件监视器，处理监听和错误处理逻辑"""
     def __init__(self, model_path:str, client):
@@ -695,6 +767,7 @@ class ControlFileMonitor:
         self.client = client
         self.running = False
         self.monitor_task: Optional[asyncio.Task] = None
+        self._stop_event = asyncio.Event()
         
     async def start_monitoring(self, completion_callback: Callable = None):
         self.running = True
@@ -704,22 +777,23 @@ class ControlFileMonitor:
         return self.monitor_task
     
     async def _monitor_loop(self, completion_callback: Callable = None):
-        """监听循环，定期检查控制文件状态"""
+        """监听循环：control.txt 发生变化时才读取命令值（读写见 core/control_file.py）"""
         try:
-            while self.running:
+            async for _ in watch_file(self.control_file, self._stop_event):
+                if not self.running:
+                    break
                 # 读取命令值
                 #print(f"control.txt url: {self.control_file}")
-                command_str = read_key(self.control_file, "command")
+                command_str = await control_file.aread_key(self.control_file, "command")
                 #print(f"监听control.txt, command={command_str}")
                 if not command_str:
-                        await asyncio.sleep(1)  # 1秒后重试
-                        continue
+                        continue  # 等待下一次文件变化
                 
                 if command_str in [str(ControlCommand.CSERROR), str(ControlCommand.PYERROR)]:
                     print(f"检测到致命错误（命令: {command_str}），终止任务")
 
                     # 写入EXIT命令终止依赖运行
-                    write_key(self.control_file, "command", str(ControlCommand.EXIT))
+                    await control_file.awrite_key(self.control_file, "command", str(ControlCommand.EXIT))
                     
                     # 清理资源
                     # await self._cleanup_resources()
@@ -741,9 +815,6 @@ class ControlFileMonitor:
                     self.running = False
                     print("准备推出循环")
                     break
-
-                # 每秒检查一次
-                await asyncio.sleep(1)
         except Exception as e:
             print(f"监听控制文件时出错: {str(e)}")
             if completion_callback:
@@ -766,6 +837,7 @@ class ControlFileMonitor:
     async def stop_monitoring(self):
         """停止监听"""
         self.running = False
+        self._stop_event.set()
         if self.monitor_task and not self.monitor_task.done():
             self.monitor_task.cancel()
             try:
@@ -788,6 +860,10 @@ def create_task_monitor_callback(model_path: str, client, task_terminate_event):
     if not task_terminate_event:
         raise ValueError("task_terminate_event参数不能为空")
     async def task_start_callback(data: Optional[Dict] = None):
+        # 启动通知晚于任务结束到达时不再监听
+        if task_terminate_event.is_set():
+            print("任务已结束，不再监听控制文件")
+            return
         if data and isinstance(data, dict):
             callback_model_path = data.get("model_path", model_path)
         else:
@@ -807,8 +883,13 @@ def create_task_monitor_callback(model_path: str, client, task_terminate_event):
                     task_terminate_event.set()
                     print("控制文件监听结束，已触发日志监控终止事件")
                 return
-            # 启动监听
-            await monitor.start_monitoring(on_completion)
+            # 启动监听，并等待监听结束；回调所在的任务被取消（优化流程已结束）时一并停止监听
+            monitor_task = await monitor.start_monitoring(on_completion)
+            try:
+                await monitor_task
+            finally:
+                if not monitor_task.done():
+                    await monitor.stop_monitoring()
             print("回调函数里，监听结束了吗")
             return 
         except Exception as e:
@@ -818,8 +899,7 @@ def create_task_monitor_callback(model_path: str, client, task_terminate_event):
                 task_terminate_event.set()
     return task_start_callback
 
-async def get_existing_images(SCREEN_FILE_PATH, IMAGE_EXTENSIONS) -> Set[str]:
-    """获取当前目录下所有符合条件的图片文件路径"""
+def _scan_images(SCREEN_FILE_PATH, IMAGE_EXTENSIONS) -> Set[str]:
     images = set()
     if not SCREEN_FILE_PATH.exists():
         return images
@@ -834,6 +914,10 @@ async def get_existing_images(SCREEN_FILE_PATH, IMAGE_EXTENSIONS) -> Set[str]:
                     images.add(entry.path)
     return images
 
+async def get_existing_images(SCREEN_FILE_PATH, IMAGE_EXTENSIONS) -> Set[str]:
+    """获取当前目录下所有符合条件的图片文件路径（在线程中扫描目录）"""
+    return await asyncio.to_thread(_scan_images, SCREEN_FILE_PATH, IMAGE_EXTENSIONS)
+
 async def process_new_image(image_path):
     """处理新发现的图片并推送至前端"""
     try:
@@ -859,8 +943,7 @@ async def process_new_image(image_path):
         # )
         
         # 使用 SSEImageChunk 发送图片信息
-        image_chunk_data = SSEImageChunk(imageUrl=image_path, fileName=image_file_name, altText=alt_Text)
-        yield f'event: image_chunk\ndata: {image_chunk_data.model_dump_json()}\n\n'
+        yield sse.image_chunk(image_path, image_file_name, alt_Text)
         
     except Exception as e:
         print(f"处理图片 {image_path} 时出错: {str(e)}")
@@ -877,47 +960,55 @@ async def monitor_image_files(
     #     print(f"图片监控目录不存在或不是目录: {SCREEN_FILE_PATH}")
     #     return
     
+    # 先登记监听再记录初始图片，避免两者之间新增的图片被遗漏
+    subscription = file_watch_service.subscribe([SCREEN_FILE_PATH])
+
     # 记录初始已存在的图片文件，避免监控开始时推送历史图片
     initial_images = await get_existing_images(SCREEN_FILE_PATH, IMAGE_EXTENSIONS)
     print(f"开始监控图片目录: {SCREEN_FILE_PATH}, 初始图片数量: {len(initial_images)}")
     
-    # 用于跟踪已处理过的图片，避免重复推送
-    processed_images = set(initial_images)
-    # 延长检查间隔，减少文件系统访问
-    check_interval = 2  # 2秒检查一次，比原来更长
-    last_check_time = datetime.now()
+    # 用于跟踪已处理过的图片（按文件名），避免重复推送
+    processed_images = {os.path.basename(img) for img in initial_images}
+    screen_dir = os.path.realpath(SCREEN_FILE_PATH)
     
     try:
-        while not task_terminate_event.is_set():
-             # 只有到达检查时间才执行目录扫描
-            if (datetime.now() - last_check_time).total_seconds() >= check_interval:
-                # 获取当前目录下的所有图片
-                current_images = await  get_existing_images(SCREEN_FILE_PATH, IMAGE_EXTENSIONS)
-                print("current_images: ", current_images)
-                
-                # 找出新增的图片
-                new_images = [img for img in current_images if img not in processed_images]
-                
-                for image_path in new_images:
-                    # 处理新图片
-                    image_file_name = os.path.basename(image_path)
-                    print(f"传递 图片{image_file_name}")
-                    # 构建图片信息
-                    image_url =rf"/files/{request.conversation_id}/{request.task_id}/PNGFILE/{image_file_name}"
-                    print(f"传递 图片{image_url}")
-                    alt_Text = "screenshot"
-                    image_chunk_data = SSEImageChunk(imageUrl=image_url, fileName=image_file_name, altText=alt_Text)
-                    yield f'event: image_chunk\ndata: {image_chunk_data.model_dump_json()}\n\n'
-                    
-                    # 将新图片加入已处理集合
-                    processed_images.add(image_path)
-                last_check_time = datetime.now()
-            # 控制监控频率
-            await asyncio.sleep(1)  # 每1秒检查一次新图片
+        # 只处理变更通知中的文件；空通知（监听重建或兜底）时才扫描整个目录
+        async for changed in subscription.changes(task_terminate_event):
+            if changed:
+                candidates = {
+                    path for path in changed
+                    if os.path.dirname(path) == screen_dir
+                    and os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS
+                }
+            else:
+                candidates = await get_existing_images(SCREEN_FILE_PATH, IMAGE_EXTENSIONS)
+            
+            # 找出新增的图片
+            new_images = sorted(
+                os.path.basename(img) for img in candidates
+                if os.path.basename(img) not in processed_images
+            )
+            
+            for image_file_name in new_images:
+                image_path = SCREEN_FILE_PATH / image_file_name
+                # 截图还在写入时跳过，写完后的变更通知会再次触发
+                if not await asyncio.to_thread(is_image_complete, image_path):
+                    continue
+                processed_images.add(image_file_name)
+
+                # 构建图片信息：优先推送缩略图，原图按需加载
+                base_url = rf"/files/{request.conversation_id}/{request.task_id}/PNGFILE"
+                image_url = rf"{base_url}/{image_file_name}"
+                thumb_path = await asyncio.to_thread(create_thumbnail, image_path)
+                thumb_url = rf"{base_url}/{THUMBNAIL_DIR}/{thumb_path.name}" if thumb_path else image_url
+                print(f"传递 图片{image_url}")
+                alt_Text = "screenshot"
+                yield sse.image_chunk(thumb_url, image_file_name, alt_Text, original_url=image_url)
             
     except Exception as e:
         print(f"图片监控过程出错: {str(e)}")
     finally:
+        subscription.close()
         print("图片监控任务已终止")
 
 
@@ -928,48 +1019,41 @@ async def monitor_log_files(
         task_terminate_event,
         assistant_message,
         current_user,
-        redis_client
+        message_buffer: MessageWriteBuffer
 ):
     
     if not LOG_FILE_PATH.exists():
         with open(LOG_FILE_PATH, "w", encoding="utf-8") as f:
             f.write("")  # 创建空文件
 
-    # 记录初始文件位置
-    start_position = LOG_FILE_PATH.stat().st_size
-    async with aiofiles.open(LOG_FILE_PATH, "r",encoding="utf-8") as log_file:
-
-        await log_file.seek(start_position) 
-
-        while not task_terminate_event.is_set():
-            # 1. 检查任务状态
-            try:
-                pass
-            except:
-                pass
-
-            #2. 读取新增日志
-            line = await log_file.readline()
-            if line:
-                if not line.endswith('\n'):
-                    line += '\n'
-                chunk = line #.replace("\\n", "\n")
+    # 从当前末尾开始，只推送本次任务追加的日志
+    tailer = LogTailer(LOG_FILE_PATH)
+    with file_watch_service.subscribe([LOG_FILE_PATH]) as subscription:
+        try:
+            while not task_terminate_event.is_set():
+                # 一次读取所有新增的完整行，合并为一个文本块
+                chunk = await tailer.read()
+                if not chunk:
+                    # 无新内容时等待日志文件变化
+                    await subscription.wait(task_terminate_event)
+                    continue
 
                 assistant_message.content += chunk
                 assistant_message.timestamp = datetime.now()
+                state["full_answer"] += chunk
+                await message_buffer.save(assistant_message)
 
-                text_chunk_data = SSETextChunk(text=chunk)
-                sse_chunk = f'event: text_chunk\ndata: {text_chunk_data.model_dump_json()}\n\n'
+                yield sse.text_chunk(chunk)
 
-                await save_or_update_message_in_redis(
-                    user_id=current_user.user_id, task_id=request.task_id, task_type=request.task_type,
-                    conversation_id=request.conversation_id, message=assistant_message, redis_client=redis_client
-                )
-            
-                yield sse_chunk
-                await asyncio.sleep(0.05)  # 控制发送速度
-            else:
-                # 无新内容时等待
-                await asyncio.sleep(0.05)
-
-            state["full_answer"] += line 
\ No newline at end of file
+            # 任务结束：补上剩余内容（包括没有换行的末行）
+            chunk = await tailer.read(final=True)
+            if chunk:
+                if not chunk.endswith("\n"):
+                    chunk += "\n"
+                assistant_message.content += chunk
+                assistant_message.timestamp = datetime.now()
+                state["full_answer"] += chunk
+                await message_buffer.save(assistant_message)
+                yield sse.text_chunk(chunk)
+        finally:
+            tailer.close()
@@ -5,7 +5,8 @@ from database.models import Tasks
 from apps.schemas import Message
 from core.authentication import User
 from datetime import datetime
-from apps.chat import  save_or_update_message_in_redis
+from apps.chat import MessageWriteBuffer
+from core import sse
 from apps.schemas import (
     TaskExecuteRequest,
     GenerationMetadata,
@@ -32,30 +33,23 @@ async def retrieval_stream_generator(
         metadata={},
         status="in_progress"
     )
+    message_buffer = MessageWriteBuffer(
+        user_id=current_user.user_id, task_id=request.task_id, task_type=request.task_type,
+        conversation_id=request.conversation_id, redis_client=redis_client
+    )
     try:
         # 1. 立即保存初始的 "in_progress" 消息
-        await save_or_update_message_in_redis(
-            user_id=current_user.user_id, task_id=request.task_id, task_type=request.task_type,
-            conversation_id=request.conversation_id, message=assistant_message, redis_client=redis_client
-        )
+        await message_buffer.save(assistant_message, force=True)
 
         # 2. 发送会话信息
-        conversation_info_data = SSEConversationInfo(
-            conversation_id=request.conversation_id, 
-            task_id=str(request.task_id)
-        )
-        yield f'event: conversation_info\ndata: {conversation_info_data.model_dump_json()}\n\n'
+        yield sse.conversation_info(request.conversation_id, request.task_id)
 
         # 3. 发送初始文本块并更新Redis
         initial_text = "Part retrieval completed! See:"
         assistant_message.content = initial_text
         assistant_message.timestamp = datetime.now()
-        text_chunk_data = SSETextChunk(text=initial_text)
-        yield f'event: text_chunk\ndata: {text_chunk_data.model_dump_json()}\n\n'
-        await save_or_update_message_in_redis(
-            user_id=current_user.user_id, task_id=request.task_id, task_type=request.task_type,
-            conversation_id=request.conversation_id, message=assistant_message, redis_client=redis_client
-        )
+        yield sse.text_chunk(initial_text)
+        await message_buffer.save(assistant_message)
         
         # 4. 模拟并流式发送零件数据，同时更新Redis
         mock_parts = [
@@ -70,13 +64,9 @@ async def retrieval_stream_generator(
             assistant_message.parts.append(part_dict)
             assistant_message.timestamp = datetime.now()
             
-            part_chunk_data = SSEPartChunk(part=part_data)
-            yield f'event: part_chunk\ndata: {part_chunk_data.model_dump_json()}\n\n'
+            yield sse.part_chunk(part_dict)
             
-            await save_or_update_message_in_redis(
-                user_id=current_user.user_id, task_id=request.task_id, task_type=request.task_type,
-                conversation_id=request.conversation_id, message=assistant_message, redis_client=redis_client
-            )
+            await message_buffer.save(assistant_message)
             await asyncio.sleep(0.1)
 
         # 5. 发送结束信号
@@ -85,10 +75,7 @@ async def retrieval_stream_generator(
         # 6. 最后一次更新Redis，状态为 "done"
         assistant_message.status = "done"
         assistant_message.timestamp = datetime.now()
-        await save_or_update_message_in_redis(
-            user_id=current_user.user_id, task_id=request.task_id, task_type=request.task_type,
-            conversation_id=request.conversation_id, message=assistant_message, redis_client=redis_client
-        )
+        await message_buffer.save(assistant_message)
 
         # 7. 数据库操作，保存任务状态,优化结果
         task.status = "done"
@@ -102,10 +89,9 @@ async def retrieval_stream_generator(
         assistant_message.content += f"\n\n**任务执行出错**: {e}"
         assistant_message.status = "failed"
         assistant_message.timestamp = datetime.now()
-        await save_or_update_message_in_redis(
-            user_id=current_user.user_id, task_id=request.task_id, task_type=request.task_type,
-            conversation_id=request.conversation_id, message=assistant_message, redis_client=redis_client
-        )
+        await message_buffer.save(assistant_message)
 
         error_data = json.dumps({"error": "An error occurred during task execution."})
-        yield f'event: error\ndata: {error_data}\n\n'
\ No newline at end of file
+        yield f'event: error\ndata: {error_data}\n\n'
+    finally:
+        message_buffer.close()
@@ -20,7 +20,7 @@ from core.authentication import authenticate
 from core.authentication import get_current_active_user, User
 from database.models import *
 
-from apps.chat import get_message_key, get_user_task_key
+from apps.chat import remove_user_task, delete_messages_history
 
 from config import settings
 from apps.schemas import FileRequest
@@ -288,15 +288,13 @@ async def delete_conversation(
 
     # 2. 查找并删除关联的任务及其 Redis 历史
     associated_tasks = await Tasks.filter(conversation_id=conversation_id)
-    if redis_client:
-        user_task_key = get_user_task_key(current_user.user_id)
-        for task in associated_tasks:
-            task_id_str = str(task.task_id)
-            message_key = get_message_key(current_user.user_id, task_id_str)
-            # 从用户任务哈希中删除任务
-            await redis_client.hdel(user_task_key, task_id_str)
-            # 删除任务的消息列表
-            await redis_client.delete(message_key)
+    for task in associated_tasks:
+        task_id_str = str(task.task_id)
+        if redis_client:
+            # 从用户任务哈希及时间索引中删除任务
+            await remove_user_task(current_user.user_id, task_id_str, redis_client)
+        # 删除任务的消息列表及归档（未启用 Redis 时也要删除归档）
+        await delete_messages_history(current_user.user_id, task_id_str, redis_client)
 
     # 3. 明确删除所有关联的任务
     for task in associated_tasks:
@@ -0,0 +1,202 @@
+from typing import Dict, AsyncIterator, Optional
+from datetime import datetime, timedelta
+import asyncio
+
+import redis.asyncio as aioredis
+from tortoise import timezone
+
+from database.models import Tasks
+from apps.chat import get_messages_page, save_or_update_message_in_redis
+from apps.events import TaskEventLog, record_task_events
+from apps.scheduler import release_task_slot
+from apps.schemas import Message
+from core import sse
+from core.sse import batch_text_chunks
+from config import settings
+
+
+# 后台任务执行器：任务在独立的 asyncio.Task 中运行，与发起请求的 HTTP 连接解耦。
+# 事件写入 Redis Stream（apps/events.py），任意 worker 上的任意数量订阅者都可以读取；
+# 客户端断开只会结束它自己的订阅，不会取消任务。
+#
+# 执行期间每 TASK_HEARTBEAT_INTERVAL 秒刷新心跳键 task_heartbeat:{task_id}（TTL 为 TASK_HEARTBEAT_TTL）。
+# worker 崩溃后心跳过期，后台清理任务把仍处于 running/queued 的任务标记为 failed，
+# 同时结束 Redis 中的助手消息、释放调度槽位并结束事件日志，避免任务永远停留在运行中。
+
+TASK_REAPER_LOCK_KEY = "task_reaper_lock"
+ACTIVE_TASK_STATUSES = ("running", "queued")
+
+# 本 worker 上正在执行的任务，持有引用防止被 GC 回收
+_running_tasks: Dict[str, asyncio.Task] = {}
+
+
+def get_task_heartbeat_key(task_id: str) -> str:
+    """生成任务心跳的Redis键名"""
+    return f"task_heartbeat:{task_id}"
+
+
+async def _heartbeat(redis_client: aioredis.Redis, task_id: str):
+    """任务执行期间定期刷新心跳"""
+    key = get_task_heartbeat_key(task_id)
+    while True:
+        try:
+            await redis_client.set(key, "1", ex=settings.TASK_HEARTBEAT_TTL)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"任务 {task_id} 心跳刷新失败: {e}")
+        await asyncio.sleep(settings.TASK_HEARTBEAT_INTERVAL)
+
+
+async def _drain(generator: AsyncIterator[str], redis_client: aioredis.Redis, task_id: str):
+    """消费任务生成器，文本块合并后写入事件日志"""
+    heartbeat = asyncio.create_task(_heartbeat(redis_client, task_id))
+    try:
+        async for _ in record_task_events(batch_text_chunks(generator), redis_client, task_id):
+            pass
+    except asyncio.CancelledError:
+        print(f"任务 {task_id} 的后台执行被取消")
+        raise
+    except Exception as e:
+        print(f"任务 {task_id} 后台执行异常: {e}")
+    finally:
+        heartbeat.cancel()
+        try:
+            await redis_client.delete(get_task_heartbeat_key(task_id))
+        except Exception as e:
+            print(f"任务 {task_id} 心跳清理失败: {e}")
+
+
+class TaskAlreadyRunning(RuntimeError):
+    """同一任务已有执行器在运行"""
+
+
+async def is_task_running(redis_client: aioredis.Redis, task_id: str) -> bool:
+    """任务是否正在执行：本 worker 上有执行器，或任意 worker 上的心跳仍然有效"""
+    task_id = str(task_id)
+    runner = _running_tasks.get(task_id)
+    if runner is not None and not runner.done():
+        return True
+    if settings.REDIS_AVAILABLE and redis_client:
+        return bool(await redis_client.exists(get_task_heartbeat_key(task_id)))
+    return False
+
+
+async def start_task_runner(
+        generator: AsyncIterator[str],
+        redis_client: aioredis.Redis,
+        task_id: str
+) -> asyncio.Task:
+    """
+    清空上一轮的事件日志并在后台启动任务。
+    同一任务已有执行器在运行时抛出 TaskAlreadyRunning，避免两个执行器写同一事件日志、重复结束同一条消息。
+    """
+    task_id = str(task_id)
+    existing = _running_tasks.get(task_id)
+    if existing is not None and not existing.done():
+        await generator.aclose()
+        raise TaskAlreadyRunning(f"任务 {task_id} 正在执行")
+    await TaskEventLog(redis_client, task_id).reset()
+
+    runner = asyncio.create_task(_drain(generator, redis_client, task_id), name=f"task-runner-{task_id}")
+    _running_tasks[task_id] = runner
+    runner.add_done_callback(lambda _: _running_tasks.pop(task_id, None) if _running_tasks.get(task_id) is runner else None)
+    return runner
+
+
+def get_running_task(task_id: str) -> Optional[asyncio.Task]:
+    """获取本 worker 上正在执行的任务"""
+    return _running_tasks.get(str(task_id))
+
+
+async def shutdown_task_runners(timeout: float = 5.0):
+    """应用关闭时取消仍在执行的任务"""
+    runners = list(_running_tasks.values())
+    for runner in runners:
+        runner.cancel()
+    if runners:
+        await asyncio.wait(runners, timeout=timeout)
+
+
+async def _finalize_assistant_message(task: Tasks, redis_client: aioredis.Redis):
+    """把停留在 in_progress 的最新助手消息标记为 failed"""
+    user_id, task_id = str(task.user_id), str(task.task_id)
+    page = await get_messages_page(user_id, task_id, redis_client, limit=1)
+    if not page["messages"]:
+        return
+    latest = page["messages"][0]
+    if latest.get("role") != "assistant" or latest.get("status") != "in_progress":
+        return
+    message = Message(
+        role="assistant",
+        content=(latest.get("content") or "") + "\n\n**任务执行中断**: 执行该任务的服务已停止响应",
+        timestamp=datetime.now(),
+        metadata=latest.get("metadata"),
+        parts=latest.get("parts"),
+        status="failed",
+        message_id=latest.get("message_id"),
+    )
+    await save_or_update_message_in_redis(
+        user_id, task_id, task.task_type, str(task.conversation_id), message, redis_client
+    )
+
+
+async def _reap_task(task: Tasks, redis_client: aioredis.Redis) -> bool:
+    """把失联任务标记为 failed 并清理其状态；任务已被其他 worker 处理时返回 False"""
+    updated = await Tasks.filter(task_id=task.task_id, status__in=ACTIVE_TASK_STATUSES).update(status="failed")
+    if not updated:
+        return False
+    task_id = str(task.task_id)
+    await release_task_slot(redis_client, task_id)
+    await _finalize_assistant_message(task, redis_client)
+    # 通知仍在订阅事件的客户端，并结束事件日志
+    event_log = TaskEventLog(redis_client, task_id)
+    await event_log.append(sse.json_event("error", {"error": "Task was interrupted."}))
+    await event_log.close()
+    return True
+
+
+async def reap_stale_tasks(redis_client: aioredis.Redis) -> int:
+    """
+    清理一批心跳已过期的任务，返回清理的任务数。
+    只检查 updated_at 早于心跳 TTL 的任务，刚置为 running 还未启动执行器的任务不会被误判。
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.TASK_HEARTBEAT_TTL)
+    tasks = await Tasks.filter(
+        status__in=ACTIVE_TASK_STATUSES,
+        updated_at__lt=cutoff,
+    ).order_by("updated_at").limit(settings.TASK_REAPER_BATCH_SIZE)
+    if not tasks:
+        return 0
+
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for task in tasks:
+            pipe.exists(get_task_heartbeat_key(str(task.task_id)))
+        alive = await pipe.execute()
+
+    reaped = 0
+    for task, has_heartbeat in zip(tasks, alive):
+        if has_heartbeat or get_running_task(task.task_id):
+            continue
+        try:
+            if await _reap_task(task, redis_client):
+                reaped += 1
+                print(f"任务 {task.task_id} 心跳已过期，标记为 failed")
+        except Exception as e:
+            print(f"清理失联任务失败 - 任务: {task.task_id}, 错误: {e}")
+    return reaped
+
+
+async def run_task_reaper(redis_client: aioredis.Redis):
+    """后台清理循环，多个 worker 通过 Redis 锁保证同一时间只有一个在执行"""
+    while True:
+        try:
+            if settings.REDIS_AVAILABLE and redis_client and await redis_client.set(
+                TASK_REAPER_LOCK_KEY, "1", nx=True, ex=settings.TASK_REAPER_INTERVAL
+            ):
+                await reap_stale_tasks(redis_client)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"失联任务清理异常: {e}")
+        await asyncio.sleep(settings.TASK_REAPER_INTERVAL)
@@ -0,0 +1,157 @@
+from typing import AsyncIterator, Optional
+import asyncio
+import time
+
+import redis.asyncio as aioredis
+
+from database.redis import register_lua_script, run_lua_script
+from config import settings
+
+
+# 优化任务调度：算法服务同时只能执行 OPTIMIZE_MAX_SLOTS 个任务，其余任务排队等待。
+# - optimize_queue：等待队列（ZSET），分数 = 入队毫秒时间 - 优先级 * 1e12，优先级高的先出队，同优先级先进先出
+# - optimize_queue_seen：等待者的存活期限（ZSET），等待者每次轮询时续期，进程崩溃后过期出队，不会堵住队列
+# - optimize_slots：已占用的执行槽位（ZSET），分数为租约到期时间；持有者定期续租，崩溃后租约过期自动释放
+# 所有 worker 共享同一组键，槽位数对整个部署生效。
+
+OPTIMIZE_QUEUE_KEY = "optimize_queue"
+OPTIMIZE_QUEUE_SEEN_KEY = "optimize_queue_seen"
+OPTIMIZE_SLOTS_KEY = "optimize_slots"
+
+# 入队（已在队列中则保持原位置）并尝试占用槽位。
+# 返回 0 表示已占用槽位，n > 0 表示前面还有 n - 1 个任务在等待
+ACQUIRE_SLOT_LUA = """
+local now = tonumber(ARGV[2])
+local max_slots = tonumber(ARGV[5])
+redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', now)
+local gone = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now)
+for _, member in ipairs(gone) do
+    redis.call('ZREM', KEYS[1], member)
+    redis.call('ZREM', KEYS[2], member)
+end
+
+if redis.call('ZSCORE', KEYS[3], ARGV[1]) then
+    redis.call('ZADD', KEYS[3], now + tonumber(ARGV[3]), ARGV[1])
+    return 0
+end
+
+redis.call('ZADD', KEYS[1], 'NX', ARGV[4], ARGV[1])
+redis.call('ZADD', KEYS[2], now + tonumber(ARGV[6]), ARGV[1])
+local rank = redis.call('ZRANK', KEYS[1], ARGV[1])
+local free = max_slots - redis.call('ZCARD', KEYS[3])
+if rank < free then
+    redis.call('ZREM', KEYS[1], ARGV[1])
+    redis.call('ZREM', KEYS[2], ARGV[1])
+    redis.call('ZADD', KEYS[3], now + tonumber(ARGV[3]), ARGV[1])
+    return 0
+end
+if free < 0 then
+    free = 0
+end
+return rank - free + 1
+"""
+register_lua_script("acquire_optimize_slot", ACQUIRE_SLOT_LUA)
+
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+async def release_task_slot(redis_client: aioredis.Redis, task_id):
+    """释放任务占用的槽位并移出等待队列（任务结束或被判定失联时调用）"""
+    task_id = str(task_id)
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.zrem(OPTIMIZE_QUEUE_KEY, task_id)
+        pipe.zrem(OPTIMIZE_QUEUE_SEEN_KEY, task_id)
+        pipe.zrem(OPTIMIZE_SLOTS_KEY, task_id)
+        await pipe.execute()
+
+
+class OptimizeSlot:
+    """
+    单个优化任务的执行槽位。
+    用法：async for position in slot.wait(): ...（排队期间产出排队位置，占到槽位后结束），
+    执行结束或出错时 release()。
+    未启用 Redis 时退回进程内信号量，不报告排队位置。
+    """
+    _local_slots: Optional[asyncio.Semaphore] = None
+
+    def __init__(self, redis_client: aioredis.Redis, task_id, priority: int = 0):
+        self.redis_client = redis_client
+        self.task_id = str(task_id)
+        self.priority = priority
+        self.acquired = False
+        self._enqueued_at = _now_ms()
+        self._renew_task: Optional[asyncio.Task] = None
+        self._use_redis = bool(settings.REDIS_AVAILABLE and redis_client)
+
+    async def _try_acquire(self) -> int:
+        return int(await run_lua_script(
+            self.redis_client, "acquire_optimize_slot",
+            [OPTIMIZE_QUEUE_KEY, OPTIMIZE_QUEUE_SEEN_KEY, OPTIMIZE_SLOTS_KEY],
+            [
+                self.task_id,
+                _now_ms(),
+                int(settings.OPTIMIZE_SLOT_LEASE * 1000),
+                self._enqueued_at - self.priority * 10 ** 12,
+                settings.OPTIMIZE_MAX_SLOTS,
+                int(settings.OPTIMIZE_QUEUE_TTL * 1000),
+            ]
+        ))
+
+    async def wait(self) -> AsyncIterator[int]:
+        """排队直到占到槽位，排队位置变化时产出新位置（从 1 开始）"""
+        if not self._use_redis:
+            if OptimizeSlot._local_slots is None:
+                OptimizeSlot._local_slots = asyncio.Semaphore(settings.OPTIMIZE_MAX_SLOTS)
+            await OptimizeSlot._local_slots.acquire()
+            self.acquired = True
+            return
+
+        last_position = None
+        while True:
+            position = await self._try_acquire()
+            if position == 0:
+                break
+            if position != last_position:
+                last_position = position
+                yield position
+            await asyncio.sleep(settings.OPTIMIZE_QUEUE_POLL_INTERVAL)
+
+        self.acquired = True
+        self._renew_task = asyncio.create_task(self._renew(), name=f"optimize-slot-{self.task_id}")
+        print(f"任务 {self.task_id} 占用优化槽位")
+
+    async def _renew(self):
+        """定期续租，进程存活期间槽位不会过期"""
+        while True:
+            await asyncio.sleep(settings.OPTIMIZE_SLOT_LEASE / 3)
+            try:
+                await self.redis_client.zadd(
+                    OPTIMIZE_SLOTS_KEY,
+                    {self.task_id: _now_ms() + int(settings.OPTIMIZE_SLOT_LEASE * 1000)},
+                    xx=True
+                )
+            except Exception as e:
+                print(f"优化槽位续租失败 {self.task_id}: {e}")
+
+    async def release(self):
+        """释放槽位并退出队列，可重复调用"""
+        if self._renew_task:
+            self._renew_task.cancel()
+            self._renew_task = None
+        if not self._use_redis:
+            if self.acquired:
+                OptimizeSlot._local_slots.release()
+            self.acquired = False
+            return
+
+        was_acquired, self.acquired = self.acquired, False
+        try:
+            await release_task_slot(self.redis_client, self.task_id)
+        except Exception as e:
+            # 释放失败时槽位在租约到期后自动回收
+            print(f"释放优化槽位失败 {self.task_id}: {e}")
+            return
+        if was_acquired:
+            print(f"任务 {self.task_id} 释放优化槽位")
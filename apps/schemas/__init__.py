@@ -69,6 +69,8 @@ from .tasks import (
     SSEConversationInfo,
     SSETextChunk,
     SSEResponse,
+    SSESuggestedQuestions,
+    SSEQueuePosition,
     PartData,
     SSEPartChunk,
     SSEImageChunk
@@ -131,6 +133,8 @@ __all__ = [
     "SSEConversationInfo",
     "SSETextChunk",
     "SSEResponse",
+    "SSESuggestedQuestions",
+    "SSEQueuePosition",
     "PartData",
     "SSEPartChunk",
     "SSEImageChunk",
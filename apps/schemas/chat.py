@@ -9,4 +9,5 @@ class Message(BaseModel):
     metadata: Optional[Dict[str, Any]] = None
     parts: Optional[List[Dict[str, Any]]] = None
     status: Optional[str] = "done" # 新增字段，默认为 'done'
+    message_id: Optional[str] = None # 助手消息增量存储时的标识
 
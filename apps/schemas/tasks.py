@@ -46,6 +46,7 @@ class TaskExecuteRequest(BaseModel):
     query: Optional[str] = Field(None, description="用户的文本输入")
     file_url: Optional[str] = Field(None, description="上传文件的URL")
     files: Optional[List[FileItem]] = Field(None, description="文件列表")
+    no_cache: bool = Field(False, description="跳过几何建模结果缓存，强制重新生成")
 
 class PendingTaskResponse(BaseModel):
     """待处理任务的响应体模型"""
@@ -104,6 +105,17 @@ class SSEResponse(BaseModel):
     suggested_questions: Optional[SuggestedQuestionsResponse] = None  # 新增：建议问题列表
     metadata: GenerationMetadata
 
+class SSESuggestedQuestions(BaseModel):
+    """message_end 之后才返回的建议问题"""
+    event: str = "suggested_questions"
+    suggested_questions: SuggestedQuestionsResponse
+
+class SSEQueuePosition(BaseModel):
+    """优化任务排队等待执行槽位时的排队位置"""
+    event: str = "queue_position"
+    task_id: str
+    position: int
+
 # --- 新增：用于零件检索的SSE模型 ---
 class PartData(BaseModel):
     """单个零件的数据模型"""
@@ -122,4 +134,5 @@ class SSEImageChunk(BaseModel):
     event: str = "image_chunk"
     imageUrl: str
     fileName: str
-    altText: Optional[str] = None
\ No newline at end of file
+    altText: Optional[str] = None
+    originalUrl: Optional[str] = None  # imageUrl 为缩略图时，原图地址
\ No newline at end of file
@@ -7,19 +7,23 @@ import time
 
 import uuid
 from pathlib import Path
-from fastapi import APIRouter, Depends, HTTPException, status, Request
+from fastapi import APIRouter, Depends, HTTPException, status, Request, Header, Query
 from pydantic import BaseModel, Field
 from fastapi.responses import StreamingResponse
 from tortoise.transactions import in_transaction
 
 from core.authentication import get_current_active_user, User
 from database.models import Tasks, Conversations, GeometryResults, OptimizationResults
-from apps.chat import save_message_to_redis, save_or_update_message_in_redis
+from apps.chat import save_message_to_redis, save_or_update_message_in_redis, restore_archived_history
+from apps.events import stream_task_events, is_valid_event_id, task_event_log_exists
+from apps.runner import start_task_runner, is_task_running, TaskAlreadyRunning
+from core.sse import batch_text_chunks
+from core import control_file
 from apps.geometry import  DifyClient
 from apps.geometry import geometry_stream_generator
 from apps.retrieval import retrieval_stream_generator
 from apps.optimize import optimize_stream_generator
-from apps.optimize import AlgorithmClient, create_task_monitor_callback, write_key
+from apps.optimize import AlgorithmClient, create_task_monitor_callback
 
 
 from config import settings
@@ -66,6 +70,17 @@ router = APIRouter(
 #         await client.close()
 
 
+async def stream_in_background(generator, redis_client, task_id) -> StreamingResponse:
+    """
+    任务在后台执行，响应只是订阅它的事件日志；客户端断开不影响任务继续执行。
+    Redis 不可用时退回在请求内直接执行。
+    """
+    if not (settings.REDIS_AVAILABLE and redis_client):
+        return StreamingResponse(batch_text_chunks(generator), media_type="text/event-stream")
+    await start_task_runner(generator, redis_client, task_id)
+    return StreamingResponse(stream_task_events(redis_client, str(task_id)), media_type="text/event-stream")
+
+
 # --- API 端点实现 ---
 
 @router.get("/pending", response_model=List[PendingTaskResponse], summary="获取所有待处理的任务")
@@ -164,6 +179,9 @@ async def execute_task(
         根据 task_type 执行一个已创建的任务。
         """
         print(f"--- Received request to execute task: {request.task_id} ({request.task_type}) ---")
+        # 上一轮仍在执行时拒绝重复启动
+        if await is_task_running(redis_client, request.task_id):
+            raise TaskAlreadyRunning(f"任务 {request.task_id} 正在执行")
         # 数据库事务
         task = await Tasks.get_or_none(
                 task_id=request.task_id, 
@@ -184,27 +202,15 @@ async def execute_task(
             #         detail=f"Task {task.task_id} is not in a valid state to start execution. Current state: {task.status}"
             #     )
             # print("通过status验证了吗")
-            # 检查是否已经有一个 "optimize" 类型的任务在运行
-            if request.task_type == "optimize":
-                running_optimize_task = await Tasks.filter(
-                    # user_id=current_user.user_id,
-                    task_type="optimize",
-                    status="running"
-                ).first()
-                print(running_optimize_task)
-                
-                if running_optimize_task:
-                    print(f"{running_optimize_task.task_id} 任务是运行状态")
-                    raise HTTPException(
-                        status_code=status.HTTP_400_BAD_REQUEST,
-                        detail=f"Task {running_optimize_task.task_id} is already running. Only one 'optimize' task can run at a time."
-                    )
-            print("通过optimize验证了吗")
+            # "optimize" 任务受算法服务容量限制，先进入排队状态，占到执行槽位后才变为运行中（见 apps/scheduler.py）
             # 更新任务状态为“处理中”
-            task.status = "running"
+            task.status = "queued" if request.task_type == "optimize" else "running"
             await task.save()
 
         print("出事务")
+        # 已归档的任务继续对话时，先把历史恢复到 Redis
+        if settings.REDIS_AVAILABLE and redis_client:
+            await restore_archived_history(current_user.user_id, request.task_id, redis_client, persist=True)
         # --- 新增：在执行任务前，保存用户的消息 ---
         if request.query:
             user_message = Message(
@@ -241,28 +247,31 @@ async def execute_task(
         
         if request.task_type == "geometry":
             
-            return StreamingResponse(
+            return await stream_in_background(
                 geometry_stream_generator(
                     request,
                     current_user,
                     redis_client,
                     combinde_query,
-                    task
-                ), 
-                media_type="text/event-stream"
+                    task,
+                    dify_http=getattr(global_request.app.state, "dify_http", None)
+                ),
+                redis_client,
+                request.task_id
             )
 
         elif request.task_type == "retrieval":
         
-            return StreamingResponse(
+            return await stream_in_background(
                 retrieval_stream_generator(
                     request,
                     current_user,
                     redis_client,
                     combinde_query,
                     task
-                ), 
-                media_type="text/event-stream"
+                ),
+                redis_client,
+                request.task_id
             )
 
 
@@ -286,15 +295,17 @@ async def execute_task(
             #     print(f"已复制：{swg_path} -> {dst_path}")
 
             
-            return StreamingResponse(
+            return await stream_in_background(
                 optimize_stream_generator(
                     request,
                     current_user,
                     redis_client,
                     combinde_query,
-                    task
-                ), 
-                media_type="text/event-stream"
+                    task,
+                    algorithm_client=getattr(global_request.app.state, "algorithm_client", None)
+                ),
+                redis_client,
+                request.task_id
             )
 
         else:
@@ -322,6 +333,12 @@ async def execute_task(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail=f"Unknown task type: {request.task_type}"
             )
+    except TaskAlreadyRunning as e:
+        # 任务仍在执行，不改变其状态
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=str(e)
+        )
     except Exception as e:
         # 更新任务状态为 "failed"
         task.status = "failed"
@@ -331,6 +348,42 @@ async def execute_task(
             detail=f"Task execution failed: {str(e)}"
         )
 
+@router.get("/{task_id}/stream", summary="重连任务的SSE事件流")
+async def reconnect_task_stream(
+    global_request: Request,
+    task_id: int,
+    last_event_id: Optional[str] = Header(None, alias="Last-Event-ID"),
+    cursor: Optional[str] = Query(None, description="Last-Event-ID 的查询参数形式，无法设置请求头时使用"),
+    current_user: User = Depends(get_current_active_user)
+):
+    """
+    断线重连：只补发 Last-Event-ID 之后的事件，然后接上实时事件流。
+    不带 Last-Event-ID 时从本轮执行的第一个事件开始。
+    """
+    redis_client = global_request.app.state.redis
+    if not (settings.REDIS_AVAILABLE and redis_client):
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Event log is unavailable.")
+    task = await Tasks.get_or_none(task_id=task_id, user_id=current_user.user_id)
+    if not task:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Task not found or does not belong to the current user."
+        )
+    # 响应开始后再出错客户端只能看到中断的流，参数与日志在这里先检查
+    event_id = last_event_id or cursor
+    if event_id and not is_valid_event_id(event_id):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid event id: {event_id}")
+    if not await task_event_log_exists(redis_client, str(task_id)):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="No event log for this task. It may have expired or never run."
+        )
+    return StreamingResponse(
+        stream_task_events(redis_client, str(task_id), event_id),
+        media_type="text/event-stream"
+    )
+
+
 @router.post("/optimize/submit-params", summary="提交优化参数")
 async def submit_optimization_params(
     request_data: OptimizationParamsRequest,
@@ -368,10 +421,9 @@ async def submit_optimization_params(
     try:
 
         #response = await algorithm_client.send_parameter(model_path, request_data.params)
-        with open(rf"{model_path}\parameters.txt", "w", encoding="utf-8") as f:
-                json.dump(request_data.params, f)
-        control_file = os.path.join(model_path, "control.txt")
-        write_key(control_file, "command", "8")
+        # 先原子写入参数文件，再更新命令，优化程序读到命令时参数已完整
+        await control_file.awrite_json(os.path.join(model_path, "parameters.txt"), request_data.params)
+        await control_file.awrite_key(os.path.join(model_path, "control.txt"), "command", "8")
         #await algorithm_client.close  ()  # 关闭客户端连接
         # 模拟成功响应
         return {"message": "Parameters received successfully and printed to console."}
@@ -44,6 +44,88 @@ class Settings(BaseSettings):
     DIFY_LISTEN_PORT: int
     DIFY_TARGET_HOST: str
     DIFY_TARGET_PORT: int
+
+    # 流式输出时助手消息的写回缓冲：满足任一预算即落盘到Redis
+    MESSAGE_FLUSH_INTERVAL: float = 1.0  # 秒
+    MESSAGE_FLUSH_BYTES: int = 4096      # 自上次落盘以来新增的字符数
+    # 用户任务列表中 last_message 预览的最大长度
+    MAX_MESSAGE_LENGTH: int = 100
+    # 对话存储编码：json / msgpack，msgpack 超过阈值（字节）时再做 zstd 压缩
+    MESSAGE_CODEC: str = "msgpack"
+    MESSAGE_COMPRESS_THRESHOLD: int = 1024
+    # 冷数据归档：已完成/失败且超过 N 天未更新的任务对话从 Redis 移入 SQL
+    ARCHIVE_AFTER_DAYS: int = 30
+    ARCHIVE_INTERVAL: int = 3600          # 归档扫描间隔（秒）
+    ARCHIVE_BATCH_SIZE: int = 100         # 每轮最多归档的任务数
+    ARCHIVE_REWARM_TTL: int = 86400       # 访问归档后回填到 Redis 的过期时间（秒）
+    # 任务 SSE 事件日志（断线重连补发）
+    TASK_EVENT_MAXLEN: int = 5000         # 每个任务最多保留的事件数
+    TASK_EVENT_TTL: int = 3600            # 执行结束后事件日志保留时间（秒）
+    TASK_EVENT_BATCH: int = 200           # 每次读取的事件数
+    TASK_EVENT_BLOCK_MS: int = 15000      # 跟随实时事件时 XREAD 的阻塞时间，超时发送保活注释
+    # Dify 共享连接池
+    DIFY_MAX_CONNECTIONS: int = 100
+    DIFY_MAX_KEEPALIVE_CONNECTIONS: int = 20
+    DIFY_KEEPALIVE_EXPIRY: float = 60.0   # 空闲连接保留时间（秒）
+    DIFY_TIMEOUT: float = 300.0           # 读写超时（秒）
+    DIFY_CONNECT_TIMEOUT: float = 10.0
+    DIFY_HTTP2: bool = True               # 安装 h2 时启用
+    # 建议问题：message_end 前最多等待的时间；message_end 之后补发时，从发出请求算起的最长等待（秒）
+    SUGGESTION_TIMEOUT: float = 1.0
+    SUGGESTION_LATE_TIMEOUT: float = 10.0
+    # 上游服务容错：熔断、重试、对冲、健康探测
+    CIRCUIT_FAILURE_THRESHOLD: int = 5    # 连续失败次数达到后熔断
+    CIRCUIT_RESET_TIMEOUT: float = 30.0   # 熔断冷却时间（秒）
+    RETRY_ATTEMPTS: int = 3               # 幂等请求最多尝试次数
+    RETRY_BASE_DELAY: float = 0.2         # 退避基准（秒），实际等待为 [0, base*2^n] 内的随机值
+    RETRY_MAX_DELAY: float = 2.0
+    HEDGE_AFTER: float = 1.0              # 幂等请求超过该时间未返回时发出对冲请求，0 关闭
+    HEALTH_PROBE_INTERVAL: float = 10.0   # 后台健康探测间隔（秒）
+    HEALTH_PROBE_TIMEOUT: float = 3.0
+    # 算法服务共享连接池（lifespan 创建，所有优化任务复用）
+    ALGORITHM_MAX_CONNECTIONS: int = 100
+    ALGORITHM_MAX_KEEPALIVE_CONNECTIONS: int = 20
+    ALGORITHM_KEEPALIVE_EXPIRY: float = 60.0  # 空闲连接保持时间（秒）
+    ALGORITHM_HEALTH_TTL: float = 30.0        # 健康状态缓存有效期（秒），过期后提交任务前重新探测
+    # 算法服务任务状态推送：连接 {ALGORITHM_EVENTS_PATH}/{task_id}，连接不可用期间退回轮询
+    ALGORITHM_EVENTS_PATH: str = "/ws"
+    ALGORITHM_WS_RECONNECT_MAX: float = 30.0  # 重连退避上限（秒）
+    ALGORITHM_WS_PING_INTERVAL: float = 10.0  # 连接空闲多久发送一次 ping（秒）
+    ALGORITHM_STATUS_POLL_INTERVAL: float = 5.0
+    ALGORITHM_START_TIMEOUT: float = 30.0     # 等待启动通知的最长时间（秒），超时后直接开始监听控制文件
+    # 文件变更监听（control.txt 等），优先 inotify，不可用时轮询
+    FILE_WATCH_FORCE_POLLING: bool = False  # 强制轮询（如网络盘上 inotify 不生效）
+    FILE_WATCH_POLL_INTERVAL: float = 0.5   # 轮询间隔（秒）
+    FILE_WATCH_STEP_MS: int = 20            # 收到变更后等待后续变更的时间（毫秒），即通知延迟
+    FILE_WATCH_DEBOUNCE_MS: int = 200       # 持续变更时最长合并时间（毫秒）
+    FILE_WATCH_RESYNC: float = 5.0          # 无事件时的兜底重新读取间隔（秒）
+    LOG_TAIL_READ_BYTES: int = 262144       # 日志增量读取单次最多读取的字节数
+    LOG_TAIL_DRAIN_TIMEOUT: float = 5.0     # 任务结束后等待日志补读剩余内容的最长时间（秒）
+    # 任务心跳与失联任务清理
+    TASK_HEARTBEAT_INTERVAL: float = 10.0     # 心跳刷新间隔（秒）
+    TASK_HEARTBEAT_TTL: int = 30              # 心跳过期时间（秒），过期后任务被判定为失联
+    TASK_REAPER_INTERVAL: int = 30            # 清理检查间隔（秒）
+    TASK_REAPER_BATCH_SIZE: int = 100
+    # 优化任务调度：全部署共享的算法执行槽位
+    OPTIMIZE_MAX_SLOTS: int = 1               # 算法服务可同时执行的优化任务数
+    OPTIMIZE_SLOT_LEASE: float = 60.0         # 槽位租约（秒），持有者每 1/3 租约续期一次，崩溃后到期释放
+    OPTIMIZE_QUEUE_TTL: float = 30.0          # 等待者未续期超过该时间视为已离开队列（秒）
+    OPTIMIZE_QUEUE_POLL_INTERVAL: float = 1.0 # 排队时检查槽位的间隔（秒）
+    # 与优化程序通信的控制文件：原子替换被占用时的重试
+    CONTROL_FILE_REPLACE_RETRIES: int = 5
+    CONTROL_FILE_REPLACE_DELAY: float = 0.02  # 秒
+    # 优化任务截图缩略图（需安装 Pillow）
+    SCREENSHOT_THUMBNAIL_ENABLED: bool = True
+    SCREENSHOT_THUMBNAIL_SIZE: int = 480      # 最长边像素
+    SCREENSHOT_THUMBNAIL_QUALITY: int = 70    # WebP 质量
+    # 几何建模结果缓存
+    GEOMETRY_CACHE_ENABLED: bool = True
+    GEOMETRY_CACHE_TTL: int = 604800      # 最近一次访问后保留的时间（秒）
+    GEOMETRY_CACHE_MAX_ENTRIES: int = 500
+    GEOMETRY_CONTEXT_MESSAGES: int = 10   # 缓存回放后的轮次新建 Dify 会话时，带上的历史消息条数
+    # SSE 文本块合并：窗口内连续的 text_chunk 合并为一帧
+    SSE_BATCH_WINDOW: float = 0.03        # 秒
+    SSE_BATCH_BYTES: int = 4096
     model_config = SettingsConfigDict(env_file=".env")
 
     # class Settings:
@@ -0,0 +1,107 @@
+"""
+对话存储（Redis）的消息编解码层，冷数据归档（SQL）也复用同一格式。
+
+写入的数据以首字节区分格式版本，读取时自动识别：
+- 0x01：msgpack
+- 0x02：zstd 压缩后的 msgpack（超过 MESSAGE_COMPRESS_THRESHOLD 字节时）
+- 其他：旧的 JSON 文本，保持可读
+
+Redis 连接池使用 decode_responses=True + surrogateescape，
+二进制数据读出来是 str，decode_message 会按 surrogateescape 还原为原始字节。
+"""
+import json
+from typing import Any, Dict, Union
+
+try:
+    import msgpack
+except ImportError:  # 未安装时退回 JSON
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:  # 未安装时不压缩
+    zstandard = None
+
+from config import settings
+
+
+MSGPACK_VERSION = 0x01
+MSGPACK_ZSTD_VERSION = 0x02
+
+
+class JsonCodec:
+    """旧格式：纯 JSON 文本"""
+    name = "json"
+
+    def encode(self, data: Any) -> str:
+        return json.dumps(data)
+
+
+class MsgpackCodec:
+    """msgpack 编码，超过阈值时再做 zstd 压缩"""
+    name = "msgpack"
+
+    def __init__(self, compress_threshold: int = 1024, level: int = 3):
+        self.compress_threshold = compress_threshold
+        self._compressor = zstandard.ZstdCompressor(level=level) if zstandard else None
+
+    def encode(self, data: Any) -> bytes:
+        payload = msgpack.packb(data, use_bin_type=True)
+        if self._compressor and len(payload) >= self.compress_threshold:
+            return bytes([MSGPACK_ZSTD_VERSION]) + self._compressor.compress(payload)
+        return bytes([MSGPACK_VERSION]) + payload
+
+
+_decompressor = zstandard.ZstdDecompressor() if zstandard else None
+
+
+def decode_message(raw: Union[str, bytes, None]) -> Any:
+    """按首字节识别格式并解码，兼容所有历史写入格式"""
+    if raw is None:
+        return None
+    if isinstance(raw, str):
+        if not raw or ord(raw[0]) not in (MSGPACK_VERSION, MSGPACK_ZSTD_VERSION):
+            return json.loads(raw)
+        raw = raw.encode("utf-8", "surrogateescape")
+
+    version, payload = raw[0], raw[1:]
+    if version in (MSGPACK_VERSION, MSGPACK_ZSTD_VERSION) and msgpack is None:
+        raise RuntimeError("数据为 msgpack 编码格式，需要安装 msgpack 才能解码")
+    if version == MSGPACK_VERSION:
+        return msgpack.unpackb(payload, raw=False)
+    if version == MSGPACK_ZSTD_VERSION:
+        if _decompressor is None:
+            raise RuntimeError("数据为 zstd 压缩格式，需要安装 zstandard 才能解码")
+        return msgpack.unpackb(_decompressor.decompress(payload), raw=False)
+    return json.loads(raw)
+
+
+_codecs: Dict[str, type] = {
+    JsonCodec.name: JsonCodec,
+    MsgpackCodec.name: MsgpackCodec,
+}
+
+
+def get_message_codec(name: str):
+    """根据配置创建编解码器，依赖缺失时退回 JSON"""
+    if name == MsgpackCodec.name:
+        if msgpack is None:
+            print("未安装 msgpack，对话存储退回 JSON 编码")
+            return JsonCodec()
+        return MsgpackCodec(compress_threshold=settings.MESSAGE_COMPRESS_THRESHOLD)
+    return _codecs.get(name, JsonCodec)()
+
+
+message_codec = get_message_codec(settings.MESSAGE_CODEC)
+
+
+def encode_message(data: Any) -> Union[str, bytes]:
+    """使用当前配置的编解码器编码"""
+    return message_codec.encode(data)
+
+
+def encode_archive(data: Any) -> bytes:
+    """归档用编码：msgpack 可用时始终压缩，否则为 UTF-8 JSON，均可由 decode_message 解码"""
+    if msgpack is None:
+        return json.dumps(data).encode("utf-8")
+    return MsgpackCodec(compress_threshold=0, level=9).encode(data)
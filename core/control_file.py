@@ -0,0 +1,139 @@
+"""
+与优化程序之间基于文件的通信：control.txt 中的 key=value 命令，parameters.txt 中的 JSON 参数。
+
+- 写入先写同目录下的临时文件再 os.replace 替换，对方读到的要么是旧内容要么是新内容，不会读到写了一半的文件；
+  Windows 下目标文件正被对方打开时替换会失败，短暂等待后重试，仍失败则退回原地截断写入（与原先的写法相同）
+- 读取按 (mtime, size, inode) 缓存解析结果，文件未变化时不再打开
+- 进程内对同一文件的读-改-写串行执行；与优化程序之间无法加锁，原子替换把冲突窗口缩小到一次改名
+- a 开头的异步版本在线程中执行，不阻塞事件循环
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Any, Dict, Optional, Tuple
+
+from config import settings
+
+
+_Signature = Tuple[int, int, int]
+
+_cache: Dict[str, Tuple[_Signature, Dict[str, str]]] = {}
+_locks: Dict[str, threading.Lock] = {}
+_locks_guard = threading.Lock()
+
+
+def _lock_for(path: str) -> threading.Lock:
+    with _locks_guard:
+        return _locks.setdefault(path, threading.Lock())
+
+
+def _signature(stat: os.stat_result) -> _Signature:
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+def parse_control(text: str) -> Dict[str, str]:
+    values = {}
+    for line in text.splitlines():
+        key, sep, value = line.strip().partition("=")
+        if sep:
+            values[key.strip()] = value.strip()
+    return values
+
+
+def read_control(path: str) -> Dict[str, str]:
+    """读取全部键值；文件不存在时返回空字典"""
+    path = os.path.abspath(path)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        _cache.pop(path, None)
+        return {}
+    cached = _cache.get(path)
+    if cached and cached[0] == _signature(stat):
+        return cached[1]
+
+    with open(path, "r", encoding="utf-8") as f:
+        values = parse_control(f.read())
+        signature = _signature(os.fstat(f.fileno()))
+    _cache[path] = (signature, values)
+    return values
+
+
+def read_key(path: str, key: str) -> Optional[str]:
+    """读取指定键的值，不存在或读取失败时返回 None"""
+    try:
+        return read_control(path).get(key)
+    except Exception as e:
+        print(f"读取键值失败（{key}）：{e}")
+        return None
+
+
+def atomic_write_text(path: str, text: str):
+    """写临时文件后原子替换目标文件；目标文件一直被占用无法替换时退回原地截断写入"""
+    directory, name = os.path.split(os.path.abspath(path))
+    tmp_path = os.path.join(directory, f".{name}.{uuid.uuid4().hex[:8]}.tmp")
+    with open(tmp_path, "w", encoding="utf-8", newline="") as f:
+        f.write(text)
+    try:
+        for attempt in range(settings.CONTROL_FILE_REPLACE_RETRIES):
+            try:
+                os.replace(tmp_path, path)
+                return
+            except PermissionError:
+                # Windows：对方正打开目标文件
+                if attempt < settings.CONTROL_FILE_REPLACE_RETRIES - 1:
+                    time.sleep(settings.CONTROL_FILE_REPLACE_DELAY)
+        # 对方持有文件时原地写入仍然可行，命令不能因为无法替换而丢失
+        print(f"替换文件失败，改为原地写入: {path}")
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            f.write(text)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def write_keys(path: str, updates: Dict[str, Any]):
+    """更新若干键，保留其余行及其顺序"""
+    path = os.path.abspath(path)
+    with _lock_for(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                lines = [line.strip() for line in f]
+        except FileNotFoundError:
+            lines = []
+
+        pending = {key: str(value) for key, value in updates.items()}
+        for i, line in enumerate(lines):
+            key = line.partition("=")[0].strip()
+            if key in pending and "=" in line:
+                lines[i] = f"{key}={pending.pop(key)}"
+        lines.extend(f"{key}={value}" for key, value in pending.items())
+
+        atomic_write_text(path, "\n".join(lines))
+        _cache.pop(path, None)
+
+
+def write_key(path: str, key: str, value: Any):
+    """写入键值对到文件"""
+    write_keys(path, {key: value})
+
+
+def write_json(path: str, data: Any):
+    path = os.path.abspath(path)
+    with _lock_for(path):
+        atomic_write_text(path, json.dumps(data))
+
+
+async def aread_key(path: str, key: str) -> Optional[str]:
+    return await asyncio.to_thread(read_key, path, key)
+
+
+async def awrite_key(path: str, key: str, value: Any):
+    await asyncio.to_thread(write_key, path, key, value)
+
+
+async def awrite_json(path: str, data: Any):
+    await asyncio.to_thread(write_json, path, data)
@@ -0,0 +1,72 @@
+"""
+截图文件处理：写入完整性判断与缩略图生成（均为同步函数，调用方放到线程中执行）。
+"""
+import os
+from pathlib import Path
+from typing import Optional
+
+try:
+    from PIL import Image
+except ImportError:  # 未安装 Pillow 时不生成缩略图
+    Image = None
+
+from config import settings
+
+
+THUMBNAIL_DIR = "thumbs"
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+_PNG_END = b"IEND\xaeB`\x82"
+
+
+def is_image_complete(path: Path) -> bool:
+    """
+    根据文件格式的结束标记判断图片是否已写完，避免推送写了一半的截图：
+    PNG 以 IEND 块结尾，JPEG 以 FFD9 结尾，GIF 以 0x3B 结尾，BMP 的文件头记录了总大小。
+    其他格式只要求文件非空。
+    """
+    try:
+        with open(path, "rb") as f:
+            head = f.read(8)
+            size = f.seek(0, os.SEEK_END)
+            if size == 0:
+                return False
+            f.seek(max(size - 12, 0))
+            tail = f.read()
+    except OSError:
+        return False
+
+    if head.startswith(_PNG_SIGNATURE):
+        return tail.endswith(_PNG_END)
+    if head.startswith(b"\xff\xd8"):
+        return tail.rstrip(b"\x00").endswith(b"\xff\xd9")
+    if head.startswith(b"GIF8"):
+        return tail.endswith(b"\x3b")
+    if head.startswith(b"BM") and len(head) >= 6:
+        return size >= int.from_bytes(head[2:6], "little")
+    return True
+
+
+def create_thumbnail(path: Path) -> Optional[Path]:
+    """
+    在图片所在目录的 thumbs/ 下生成 WebP 缩略图（最长边 SCREENSHOT_THUMBNAIL_SIZE），返回缩略图路径。
+    未安装 Pillow、关闭缩略图或生成失败时返回 None。
+    """
+    if Image is None or not settings.SCREENSHOT_THUMBNAIL_ENABLED:
+        return None
+    thumb_path = path.parent / THUMBNAIL_DIR / f"{path.stem}.webp"
+    try:
+        thumb_path.parent.mkdir(exist_ok=True)
+        with Image.open(path) as image:
+            image.draft("RGB", (settings.SCREENSHOT_THUMBNAIL_SIZE, settings.SCREENSHOT_THUMBNAIL_SIZE))
+            if image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+            image.thumbnail((settings.SCREENSHOT_THUMBNAIL_SIZE, settings.SCREENSHOT_THUMBNAIL_SIZE))
+            # 先写临时文件再改名，前端不会读到不完整的缩略图
+            tmp_path = thumb_path.with_name(f".{thumb_path.name}.tmp")
+            image.save(tmp_path, "WEBP", quality=settings.SCREENSHOT_THUMBNAIL_QUALITY, method=4)
+        os.replace(tmp_path, thumb_path)
+    except Exception as e:
+        print(f"生成缩略图失败 {path}: {e}")
+        return None
+    return thumb_path
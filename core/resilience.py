@@ -0,0 +1,219 @@
+"""
+上游服务（Dify、算法服务）调用的容错层。
+
+- CircuitBreaker：按上游维护熔断状态，连续失败达到阈值后打开，冷却期内直接快速失败，
+  冷却结束放行一次试探请求（半开），成功则关闭
+- call_idempotent：幂等调用（健康检查、任务状态、建议问题）的有界重试，指数退避 + 全抖动，
+  可选对冲请求：首个请求超过 hedge_after 秒未返回时再并发发出一个，取先成功者
+- call_once：非幂等调用（提交任务、对话）只经过熔断器，不重试
+- HealthProbe：后台定时探测上游健康状态，请求路径只读缓存结果
+"""
+import asyncio
+import random
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import httpx
+
+from config import settings
+
+
+class CircuitOpenError(Exception):
+    """熔断器打开，调用被快速拒绝"""
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"上游服务 {name} 熔断中，{retry_after:.1f} 秒后重试")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: Optional[int] = None, reset_timeout: Optional[float] = None):
+        self.name = name
+        self.failure_threshold = failure_threshold or settings.CIRCUIT_FAILURE_THRESHOLD
+        self.reset_timeout = reset_timeout or settings.CIRCUIT_RESET_TIMEOUT
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._probe_started = 0.0
+
+    def _now(self) -> float:
+        return asyncio.get_running_loop().time()
+
+    def before_call(self):
+        """调用前检查，熔断打开时抛出 CircuitOpenError"""
+        if self.state == self.OPEN:
+            elapsed = self._now() - self._opened_at
+            if elapsed < self.reset_timeout:
+                raise CircuitOpenError(self.name, self.reset_timeout - elapsed)
+            self.state = self.HALF_OPEN
+            self._probing = False
+        if self.state == self.HALF_OPEN:
+            # 半开状态只放行一个试探请求；试探结果迟迟未上报（如请求被取消）时，超过冷却时间再放行
+            now = self._now()
+            if self._probing and now - self._probe_started < self.reset_timeout:
+                raise CircuitOpenError(self.name, self.reset_timeout - (now - self._probe_started))
+            self._probing = True
+            self._probe_started = now
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            print(f"上游服务 {self.name} 已恢复，熔断关闭")
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                print(f"上游服务 {self.name} 连续失败 {self.failures} 次，熔断打开")
+            self.state = self.OPEN
+            self._opened_at = self._now()
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def get_circuit_breaker(name: str) -> CircuitBreaker:
+    """按上游名称获取熔断器，同一进程内共享"""
+    if name not in _breakers:
+        _breakers[name] = CircuitBreaker(name)
+    return _breakers[name]
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """网络错误、超时和 5xx 视为上游故障，可重试并计入熔断"""
+    if isinstance(exc, httpx.TransportError):
+        return True
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code >= 500
+    return isinstance(exc, (asyncio.TimeoutError, ConnectionError, OSError))
+
+
+async def _hedged(func: Callable[[], Awaitable[Any]], hedge_after: float) -> Any:
+    """首个请求超过 hedge_after 秒未返回时并发发出第二个，取先成功者"""
+    first = asyncio.ensure_future(func())
+    done, _ = await asyncio.wait({first}, timeout=hedge_after)
+    if done:
+        return first.result()
+
+    second = asyncio.ensure_future(func())
+    pending = {first, second}
+    error: Optional[BaseException] = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+        raise error
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+async def call_idempotent(
+        breaker: CircuitBreaker,
+        func: Callable[[], Awaitable[Any]],
+        attempts: Optional[int] = None,
+        hedge_after: Optional[float] = None,
+) -> Any:
+    """幂等调用：经过熔断器，上游故障时按指数退避 + 抖动重试"""
+    attempts = attempts or settings.RETRY_ATTEMPTS
+    hedge_after = settings.HEDGE_AFTER if hedge_after is None else hedge_after
+    for attempt in range(attempts):
+        breaker.before_call()
+        try:
+            result = await (_hedged(func, hedge_after) if hedge_after > 0 else func())
+        except Exception as e:
+            if not is_retryable(e):
+                # 4xx 等业务错误说明上游可用
+                breaker.record_success()
+                raise
+            breaker.record_failure()
+            if attempt == attempts - 1:
+                raise
+            delay = random.uniform(0, min(settings.RETRY_MAX_DELAY, settings.RETRY_BASE_DELAY * 2 ** attempt))
+            print(f"调用 {breaker.name} 失败（第 {attempt + 1} 次）: {e}，{delay:.2f} 秒后重试")
+            await asyncio.sleep(delay)
+            continue
+        breaker.record_success()
+        return result
+
+
+async def call_once(breaker: CircuitBreaker, func: Callable[[], Awaitable[Any]]) -> Any:
+    """非幂等调用：只经过熔断器，不重试"""
+    breaker.before_call()
+    try:
+        result = await func()
+    except Exception as e:
+        if is_retryable(e):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        raise
+    breaker.record_success()
+    return result
+
+
+class HealthProbe:
+    """
+    后台健康探测：每 interval 秒执行一次 check，结果缓存在内存中，超过 max_age 秒视为过期。
+    healthy 为 None 表示尚未探测过。
+    """
+    def __init__(
+            self,
+            name: str,
+            check: Callable[[], Awaitable[bool]],
+            interval: Optional[float] = None,
+            max_age: Optional[float] = None,
+    ):
+        self.name = name
+        self.check = check
+        self.interval = interval or settings.HEALTH_PROBE_INTERVAL
+        self.max_age = max_age or self.interval * 3
+        self.healthy: Optional[bool] = None
+        self.detail: str = ""
+        self.checked_at = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    async def probe(self) -> bool:
+        """立即探测一次并更新缓存"""
+        async with self._lock:
+            try:
+                self.healthy = bool(await asyncio.wait_for(self.check(), settings.HEALTH_PROBE_TIMEOUT))
+                self.detail = "" if self.healthy else "unhealthy"
+            except Exception as e:
+                self.healthy = False
+                self.detail = str(e) or type(e).__name__
+            self.checked_at = asyncio.get_running_loop().time()
+            return self.healthy
+
+    async def is_healthy(self) -> bool:
+        """读取缓存；从未探测或缓存过旧（后台探测未运行）时同步探测一次"""
+        if self.healthy is None or asyncio.get_running_loop().time() - self.checked_at > self.max_age:
+            return await self.probe()
+        return self.healthy
+
+    async def _run(self):
+        while True:
+            healthy_before = self.healthy
+            await self.probe()
+            if healthy_before is not None and healthy_before != self.healthy:
+                print(f"上游服务 {self.name} 健康状态变化: {'healthy' if self.healthy else 'unhealthy'} {self.detail}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name=f"health-probe-{self.name}")
+
+    def stop(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
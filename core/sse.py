@@ -0,0 +1,238 @@
+"""
+SSE 事件编码。
+
+流式热路径上的事件（text_chunk、image_chunk、part_chunk、conversation_info）
+直接用预先拼好的字节模板 + orjson 生成 bytes，不再逐块构造 Pydantic 模型。
+输出与 apps/schemas/tasks.py 中对应模型的 model_dump_json() 保持一致（字段顺序、紧凑格式）。
+message_end 不在热路径上，仍由 Pydantic 模型校验后序列化。
+
+batch_text_chunks 位于生成器与输出之间，把短时间内连续的 text_chunk 合并为一帧。
+
+SSEDecoder 用于解析上游（Dify）的 SSE 字节流。
+"""
+import asyncio
+import json
+import re
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple, Union
+
+try:
+    import orjson
+except ImportError:  # 未安装时退回标准库
+    orjson = None
+
+from pydantic import BaseModel
+
+from config import settings
+
+
+def dumps(data: Any) -> bytes:
+    """紧凑 JSON，非 ASCII 字符不转义，与 Pydantic 的输出格式一致"""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    """解析 JSON，接受 bytes"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _template(event: str) -> bytes:
+    return f'event: {event}\ndata: {{"event":"{event}",'.encode("utf-8")
+
+
+_END = b"}\n\n"
+_TEXT_CHUNK = _template("text_chunk") + b'"text":'
+_IMAGE_CHUNK = _template("image_chunk") + b'"imageUrl":'
+_PART_CHUNK = _template("part_chunk") + b'"part":'
+_CONVERSATION_INFO = _template("conversation_info") + b'"conversation_id":'
+
+
+class TextFrame(bytes):
+    """text_chunk 帧，保留原始文本以便合并"""
+    text: str
+
+
+def text_chunk(text: str) -> TextFrame:
+    """等价于 SSETextChunk(text=text)"""
+    frame = TextFrame(_TEXT_CHUNK + dumps(text) + _END)
+    frame.text = text
+    return frame
+
+
+def image_chunk(
+        image_url: str,
+        file_name: str,
+        alt_text: Optional[str] = None,
+        original_url: Optional[str] = None
+) -> bytes:
+    """等价于 SSEImageChunk(imageUrl=..., fileName=..., altText=..., originalUrl=...)"""
+    return b"".join((
+        _IMAGE_CHUNK, dumps(image_url),
+        b',"fileName":', dumps(file_name),
+        b',"altText":', dumps(alt_text),
+        b',"originalUrl":', dumps(original_url),
+        _END,
+    ))
+
+
+def part_chunk(part: Dict[str, Any]) -> bytes:
+    """等价于 SSEPartChunk(part=PartData(**part))，part 需包含 id/name/imageUrl/fileName"""
+    part_data = {
+        "id": part["id"],
+        "name": part["name"],
+        "imageUrl": part["imageUrl"],
+        "fileName": part["fileName"],
+    }
+    return _PART_CHUNK + dumps(part_data) + _END
+
+
+def conversation_info(conversation_id: str, task_id: str) -> bytes:
+    """等价于 SSEConversationInfo(conversation_id=..., task_id=...)"""
+    return b"".join((
+        _CONVERSATION_INFO, dumps(conversation_id),
+        b',"task_id":', dumps(str(task_id)),
+        _END,
+    ))
+
+
+def model_event(event: str, model: BaseModel) -> bytes:
+    """非热路径事件（如 message_end）：经 Pydantic 校验后序列化"""
+    return f"event: {event}\ndata: ".encode("utf-8") + model.model_dump_json().encode("utf-8") + b"\n\n"
+
+
+def json_event(event: str, data: Any) -> bytes:
+    """任意事件，data 序列化为 JSON"""
+    return f"event: {event}\ndata: ".encode("utf-8") + dumps(data) + b"\n\n"
+
+
+_DONE = object()
+
+
+async def batch_text_chunks(
+        source: AsyncIterator[Union[str, bytes]],
+        window: Optional[float] = None,
+        max_bytes: Optional[int] = None,
+) -> AsyncIterator[Union[str, bytes]]:
+    """
+    自适应合并连续的 text_chunk：
+    - 距上次输出文本已超过 window 秒（生产慢）时，新文本立即输出，不增加延迟
+    - 否则在 window 秒内累积，达到 max_bytes 或遇到其他事件时提前输出
+    其他事件保持原有顺序原样输出。
+    """
+    window = settings.SSE_BATCH_WINDOW if window is None else window
+    max_bytes = settings.SSE_BATCH_BYTES if max_bytes is None else max_bytes
+
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=256)
+
+    async def produce():
+        # 被取消说明消费方已退出，不再放入结束标记：队列已满时放入会永远阻塞
+        try:
+            async for item in source:
+                await queue.put(item)
+        except Exception as e:
+            await queue.put(e)
+        await queue.put(_DONE)
+
+    producer = asyncio.create_task(produce())
+    texts: list = []
+    size = 0
+    deadline = 0.0
+    last_text = -window
+
+    def merged() -> TextFrame:
+        nonlocal texts, size, last_text
+        frame = text_chunk("".join(texts))
+        texts, size = [], 0
+        last_text = loop.time()
+        return frame
+
+    try:
+        while True:
+            try:
+                if texts:
+                    item = await asyncio.wait_for(queue.get(), max(deadline - loop.time(), 0))
+                else:
+                    item = await queue.get()
+            except asyncio.TimeoutError:
+                yield merged()
+                continue
+
+            if isinstance(item, TextFrame):
+                if not texts and loop.time() - last_text >= window:
+                    last_text = loop.time()
+                    yield item
+                    continue
+                if not texts:
+                    deadline = loop.time() + window
+                texts.append(item.text)
+                size += len(item)
+                if size >= max_bytes:
+                    yield merged()
+                continue
+
+            if texts:
+                yield merged()
+            if item is _DONE:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        producer.cancel()
+
+
+class SSEDecoder:
+    """
+    增量 SSE 解析器：按任意边界喂入原始字节，返回已完整的事件 (event, data)。
+    - 支持 \n 与 \r\n 换行、多行 data: 字段（以 \n 拼接）、注释行
+    - 不对数据做解码，由调用方决定是否解析 JSON
+    """
+    def __init__(self):
+        self._buffer = bytearray()
+        self._event: Optional[str] = None
+        self._data: List[bytes] = []
+
+    def feed(self, chunk: bytes) -> List[Tuple[Optional[str], bytes]]:
+        self._buffer += chunk
+        events = []
+        start = 0
+        while True:
+            end = self._buffer.find(b"\n", start)
+            if end < 0:
+                break
+            line = self._buffer[start:end]
+            start = end + 1
+            if line.endswith(b"\r"):
+                line = line[:-1]
+
+            # 空行：分发当前事件
+            if not line:
+                if self._data:
+                    events.append((self._event, b"\n".join(self._data)))
+                self._event, self._data = None, []
+                continue
+            if line.startswith(b":"):
+                continue
+            field, _, value = line.partition(b":")
+            if value.startswith(b" "):
+                value = value[1:]
+            if field == b"data":
+                self._data.append(bytes(value))
+            elif field == b"event":
+                self._event = value.decode("utf-8")
+        del self._buffer[:start]
+        return events
+
+
+# 数据中 "event" 字段的位置，Dify 的事件 JSON 中它位于开头
+_EVENT_TYPE = re.compile(rb'"event"\s*:\s*"([^"\\]*)"')
+
+
+def peek_event_type(data: bytes) -> Optional[str]:
+    """不解析整个 JSON，只取出 event 字段"""
+    match = _EVENT_TYPE.search(data, 0, 128) or _EVENT_TYPE.search(data)
+    return match.group(1).decode("utf-8") if match else None
@@ -0,0 +1,100 @@
+"""
+追加写入日志文件的增量读取（如算法服务的 backend_log.txt）。
+
+- 每次读取当前所有新增字节（单次最多 LOG_TAIL_READ_BYTES），在线程中执行，一次性按行切分
+- 不完整的末行保留到下一次读取；UTF-8 增量解码，多字节字符跨越读取边界也不会乱码
+- 文件变小（被截断）时从头读取；文件被轮转（路径指向新文件）时先读完旧文件剩余内容，再切换到新文件
+"""
+import asyncio
+import codecs
+import os
+from pathlib import Path
+from typing import BinaryIO, Optional, Union
+
+from config import settings
+
+
+class LogTailer:
+    def __init__(self, path: Union[str, Path], from_end: bool = True):
+        """from_end=True 时从文件当前末尾开始，只读取之后追加的内容；文件尚不存在时之后从头读取"""
+        self.path = Path(path)
+        self._file: Optional[BinaryIO] = None
+        self._position = 0
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._partial = ""
+        self._lock = asyncio.Lock()
+        self._open(at_end=from_end)
+
+    def _open(self, at_end: bool) -> bool:
+        try:
+            self._file = open(self.path, "rb")
+        except FileNotFoundError:
+            return False
+        self._position = os.fstat(self._file.fileno()).st_size if at_end else 0
+        self._file.seek(self._position)
+        return True
+
+    def _restart(self):
+        """截断或轮转后重新开始解码，旧文件中不完整的末行作为单独一行输出"""
+        self._decoder.reset()
+        if self._partial:
+            self._partial += "\n"
+
+    def _rotated(self) -> bool:
+        """路径已指向另一个文件"""
+        try:
+            current = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        opened = os.fstat(self._file.fileno())
+        return (current.st_ino, current.st_dev) != (opened.st_ino, opened.st_dev)
+
+    def _read_bytes(self) -> bytes:
+        if self._file is None and not self._open(at_end=False):
+            return b""
+
+        if os.fstat(self._file.fileno()).st_size < self._position:
+            print(f"日志文件被截断，从头读取: {self.path}")
+            self._file.seek(0)
+            self._position = 0
+            self._restart()
+
+        data = self._file.read(settings.LOG_TAIL_READ_BYTES)
+        if not data and self._rotated():
+            print(f"日志文件已轮转，切换到新文件: {self.path}")
+            self._file.close()
+            self._restart()
+            if not self._open(at_end=False):
+                self._file = None
+                return b""
+            data = self._file.read(settings.LOG_TAIL_READ_BYTES)
+        self._position += len(data)
+        return data
+
+    def _read(self, final: bool) -> str:
+        while True:
+            data = self._read_bytes()
+            text = self._partial + self._decoder.decode(data, final=final)
+            if final:
+                self._partial = ""
+                complete = text
+            else:
+                complete, newline, self._partial = text.rpartition("\n")
+                complete += newline
+            # 单行超过一次读取上限时继续读，直到凑出完整的行
+            if complete or len(data) < settings.LOG_TAIL_READ_BYTES:
+                return complete.replace("\r\n", "\n")
+
+    async def read(self, final: bool = False) -> str:
+        """
+        读取新增的完整行（保留换行符），没有新内容时返回空字符串。
+        一次最多读取 LOG_TAIL_READ_BYTES 字节，返回非空时调用方应继续读取直到返回空。
+        final=True 时连同不完整的末行一起返回（任务结束时使用）。
+        """
+        async with self._lock:
+            return await asyncio.to_thread(self._read, final)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
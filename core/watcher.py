@@ -0,0 +1,224 @@
+"""
+文件变更监听。
+
+FileWatchService 是进程内共享的监听服务：各任务登记关心的文件或目录（control.txt、PNGFILE/、backend_log.txt），
+所有登记合并到同一个 watchfiles 监听中（Linux 下为 inotify，Windows 下为 ReadDirectoryChangesW），
+变更按登记分发到各自的队列，空闲时没有任何轮询。
+- 登记的路径集合变化时重建监听；重建后通知所有订阅者重新检查一次，覆盖重建间隙内的修改
+- 无事件时每 FILE_WATCH_RESYNC 秒发出一次空通知作为兜底
+- 未安装 watchfiles 或系统监听资源不足时退回按 mtime/size 轮询
+"""
+import asyncio
+import os
+from pathlib import Path
+from typing import AsyncIterator, Dict, Iterable, Optional, Set, Tuple, Union
+
+try:
+    from watchfiles import awatch
+except ImportError:  # 未安装时只能轮询
+    awatch = None
+
+from config import settings
+
+
+PathLike = Union[str, Path]
+
+
+def _normalize(path: PathLike) -> str:
+    return os.path.realpath(os.fspath(path))
+
+
+class WatchSubscription:
+    """
+    一次监听登记。文件路径在其本身被修改、创建、删除或替换时匹配，目录路径在其直接子项变化时也匹配。
+    未被消费的变更会合并，队列中最多只有一项。
+    """
+    def __init__(self, service: "FileWatchService", paths: Iterable[PathLike]):
+        self.service = service
+        self.paths: Set[str] = {_normalize(path) for path in paths}
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self._pending: Set[str] = set()
+
+    def matches(self, path: str) -> bool:
+        return path in self.paths or os.path.dirname(path) in self.paths
+
+    def notify(self, changed: Set[str]):
+        if self.queue.empty():
+            self._pending = set(changed)
+            self.queue.put_nowait(self._pending)
+        else:
+            self._pending |= changed
+
+    async def wait(self, stop_event: Optional[asyncio.Event] = None) -> Optional[Set[str]]:
+        """等待下一批变更路径（空集合表示需要重新检查）；stop_event 先被设置时返回 None"""
+        if stop_event is None:
+            return await self.queue.get()
+        if stop_event.is_set():
+            return None
+        getter = asyncio.ensure_future(self.queue.get())
+        stopper = asyncio.ensure_future(stop_event.wait())
+        try:
+            await asyncio.wait({getter, stopper}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            stopper.cancel()
+            if not getter.done():
+                getter.cancel()
+        return getter.result() if getter.done() and not getter.cancelled() else None
+
+    async def changes(self, stop_event: Optional[asyncio.Event] = None) -> AsyncIterator[Set[str]]:
+        while True:
+            changed = await self.wait(stop_event)
+            if changed is None:
+                return
+            yield changed
+
+    def close(self):
+        self.service.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def _scan(directories: Iterable[str]) -> Dict[str, Tuple[int, int]]:
+    """轮询模式下的目录快照：目录本身及其直接子项的 (mtime, size)"""
+    snapshot = {}
+    for directory in directories:
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        stat = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    snapshot[entry.path] = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            continue
+    return snapshot
+
+
+async def _poll(directories: Set[str], stop_event: asyncio.Event) -> AsyncIterator[Set[str]]:
+    """按 FILE_WATCH_POLL_INTERVAL 比较目录快照，产出变化的路径；超过 FILE_WATCH_RESYNC 无变化时产出空集合"""
+    last = await asyncio.to_thread(_scan, directories)
+    idle = 0.0
+    while not stop_event.is_set():
+        try:
+            await asyncio.wait_for(stop_event.wait(), settings.FILE_WATCH_POLL_INTERVAL)
+            return
+        except asyncio.TimeoutError:
+            pass
+        current = await asyncio.to_thread(_scan, directories)
+        changed = {path for path in last.keys() | current.keys() if last.get(path) != current.get(path)}
+        last = current
+        idle += settings.FILE_WATCH_POLL_INTERVAL
+        if changed or idle >= settings.FILE_WATCH_RESYNC:
+            idle = 0.0
+            yield changed
+
+
+class FileWatchService:
+    """进程内共享的文件监听服务，第一次登记时自动启动"""
+    def __init__(self):
+        self._subscriptions: Set[WatchSubscription] = set()
+        self._task: Optional[asyncio.Task] = None
+        self._restart: Optional[asyncio.Event] = None
+        self._watched: frozenset = frozenset()
+        self._polling = False
+
+    def subscribe(self, paths: Iterable[PathLike]) -> WatchSubscription:
+        subscription = WatchSubscription(self, paths)
+        self._subscriptions.add(subscription)
+        self._reconfigure()
+        return subscription
+
+    def unsubscribe(self, subscription: WatchSubscription):
+        self._subscriptions.discard(subscription)
+        self._reconfigure()
+
+    def _watch_dirs(self) -> Set[str]:
+        """需要监听的目录：每个路径的上级目录（感知创建与替换），以及作为目录登记的路径本身"""
+        directories = set()
+        for subscription in self._subscriptions:
+            for path in subscription.paths:
+                if os.path.isdir(path):
+                    directories.add(path)
+                parent = os.path.dirname(path)
+                if os.path.isdir(parent):
+                    directories.add(parent)
+        return directories
+
+    def _reconfigure(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="file-watch-service")
+        elif self._restart is not None and self._watch_dirs() != self._watched:
+            self._restart.set()
+
+    def _dispatch(self, changed: Set[str]):
+        for subscription in list(self._subscriptions):
+            matched = {path for path in changed if subscription.matches(path)}
+            if matched or not changed:
+                subscription.notify(matched)
+        # 登记的目录被创建或删除后需要重建监听
+        if not changed or any(path in s.paths for s in self._subscriptions for path in changed):
+            if self._watch_dirs() != self._watched:
+                self._restart.set()
+
+    async def _run(self):
+        while True:
+            self._restart = asyncio.Event()
+            directories = self._watch_dirs()
+            self._watched = frozenset(directories)
+            self._dispatch(set())
+            if not directories:
+                await self._restart.wait()
+                continue
+
+            try:
+                if awatch is None or settings.FILE_WATCH_FORCE_POLLING or self._polling:
+                    async for changed in _poll(directories, self._restart):
+                        self._dispatch(changed)
+                else:
+                    async for changes in awatch(
+                        *directories,
+                        watch_filter=None,
+                        debounce=settings.FILE_WATCH_DEBOUNCE_MS,
+                        step=settings.FILE_WATCH_STEP_MS,
+                        stop_event=self._restart,
+                        rust_timeout=int(settings.FILE_WATCH_RESYNC * 1000),
+                        yield_on_timeout=True,
+                        recursive=False,
+                    ):
+                        self._dispatch({os.path.realpath(path) for _, path in changes})
+            except OSError as e:
+                # 如 inotify 监听数量达到上限
+                print(f"文件监听不可用，改为轮询，原因: {e}")
+                self._polling = True
+            except Exception as e:
+                # 服务退出后已登记的订阅不会再收到通知（如 ControlFileMonitor 等不到 EXIT），任何异常都不能让循环结束
+                print(f"文件监听异常，改为轮询，原因: {e!r}")
+                self._polling = True
+                await asyncio.sleep(settings.FILE_WATCH_POLL_INTERVAL)
+
+    def stop(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+
+
+# 进程内共享的监听服务
+file_watch_service = FileWatchService()
+
+
+async def watch_file(
+        path: PathLike,
+        stop_event: Optional[asyncio.Event] = None,
+) -> AsyncIterator[None]:
+    """
+    监听单个文件：启动时先产出一次（供调用方读取初始内容），之后文件每次被修改、创建或替换时产出一次。
+    stop_event 被设置或调用方停止迭代时结束。
+    """
+    with file_watch_service.subscribe([path]) as subscription:
+        yield
+        async for _ in subscription.changes(stop_event):
+            yield
@@ -99,3 +99,16 @@ class OptimizationResults(Model):
     class Meta:
         table = "optimization_results"
         #indexes = [("idx_task_id", ["task_id"])]
+
+
+# 冷对话历史归档（Redis 中已完成且长期未访问的任务）
+class ChatArchives(Model):
+    archive_id = fields.IntField(pk=True, auto_increment=True)
+    task_id = fields.IntField(unique=True)
+    user_id = fields.IntField()
+    payload = fields.BinaryField()  # 压缩后的完整消息列表，格式见 core/codec.py
+    message_count = fields.IntField(default=0)
+    archived_at = fields.DatetimeField(auto_now=True)
+
+    class Meta:
+        table = "chat_archives"
@@ -1,5 +1,7 @@
+from typing import Dict, List, Any
+
 import redis.asyncio as redis
-from redis.exceptions import ConnectionError, TimeoutError
+from redis.exceptions import ConnectionError, TimeoutError, NoScriptError
 from config import Settings
 
 settings = Settings()
@@ -11,6 +13,7 @@ redis_pool = redis.ConnectionPool(
     #password=settings.REDIS_PASSWORD,  # 密码
     decode_responses=True,  # 自动解码响应
     encoding='utf-8',  # 设置编码
+    encoding_errors='surrogateescape',  # 二进制编码的对话数据可无损往返，见 core/codec.py
 )
 
 
@@ -26,3 +29,35 @@ async def redis_connect():
         print("Redis connection timed out")
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
+
+
+# Lua 脚本注册表：各模块在导入时注册脚本源码，lifespan 启动时统一 SCRIPT LOAD
+_lua_scripts: Dict[str, str] = {}
+_lua_shas: Dict[str, str] = {}
+
+
+def register_lua_script(name: str, source: str):
+    """注册一个 Lua 脚本，名称需全局唯一"""
+    _lua_scripts[name] = source
+
+
+async def load_lua_scripts(redis_client: redis.Redis):
+    """将已注册的脚本加载到Redis并缓存SHA，在 lifespan 启动时调用；Redis 不可用时跳过"""
+    if redis_client is None:
+        print("Redis 不可用，跳过 Lua 脚本预加载")
+        return
+    for name, source in _lua_scripts.items():
+        _lua_shas[name] = await redis_client.script_load(source)
+    print(f"已加载 {len(_lua_shas)} 个 Lua 脚本")
+
+
+async def run_lua_script(redis_client: redis.Redis, name: str, keys: List[str], args: List[Any]):
+    """通过 EVALSHA 执行脚本；Redis 重启等原因丢失脚本时自动重新加载"""
+    sha = _lua_shas.get(name)
+    if sha is not None:
+        try:
+            return await redis_client.evalsha(sha, len(keys), *keys, *args)
+        except NoScriptError:
+            pass
+    _lua_shas[name] = await redis_client.script_load(_lua_scripts[name])
+    return await redis_client.evalsha(_lua_shas[name], len(keys), *keys, *args)
@@ -1,3 +1,4 @@
+import asyncio
 import json
 import os
 from contextlib import asynccontextmanager
@@ -11,15 +12,18 @@ import uvicorn
 
 from apps.router import router
 from apps.user import user
-from apps.geometry import geometry
-from apps.optimize import optimize
+from apps.geometry import geometry, create_dify_http_client
+from apps.optimize import optimize, AlgorithmClient
 from apps.tasks import router as tasks_router
 from apps.chat import router as chat_router
+from apps.chat import run_history_archiver
+from apps.runner import shutdown_task_runners, run_task_reaper
+from core.watcher import file_watch_service
 from core.middleware import count_time_middleware,FullRequestLoggerMiddleware
 
 from database.settings import TORTOISE_ORM_SQLITE, TORTOISE_ORM_MYSQL
 from database.sql import register_sql
-from database.redis import redis_connect
+from database.redis import redis_connect, load_lua_scripts
 from core.geometry import start_mcp, dify_api_port_forward
 from api.mcp_server import mcp_cadquery
 from config import settings
@@ -37,6 +41,9 @@ async def lifespan(app: FastAPI):
     
     #连接数据库
     app.state.redis = await redis_connect()  # 连接到 Redis 数据库
+    if settings.REDIS_AVAILABLE and app.state.redis:
+        await load_lua_scripts(app.state.redis)  # 预加载 Lua 脚本，之后统一走 EVALSHA
+    app.state.dify_http = create_dify_http_client()  # Dify 共享连接池
     #获取动态配置
 
     #启用第三方的服务
@@ -45,6 +52,11 @@ async def lifespan(app: FastAPI):
     dify_api_process = await dify_api_port_forward()
 
     #其他
+    archiver_task = asyncio.create_task(run_history_archiver(app.state.redis))  # 冷对话历史归档
+    reaper_task = asyncio.create_task(run_task_reaper(app.state.redis))  # 失联任务清理
+    # 算法服务共享客户端：连接池复用 + 健康状态后台探测
+    app.state.algorithm_client = AlgorithmClient(base_url=settings.OPTIMIZE_API_URL, shared=True)
+    app.state.algorithm_client.health.start()
     yield
     # async with register_sql(app):
     #     yield print("lifespan 启动数据库")
@@ -53,6 +65,12 @@ async def lifespan(app: FastAPI):
     #关闭日志服务
 
     #关闭数据库连接
+    archiver_task.cancel()
+    reaper_task.cancel()
+    await shutdown_task_runners()  # 取消仍在后台执行的任务，之后才能关闭它们使用的共享连接池
+    await app.state.algorithm_client.close(force=True)
+    file_watch_service.stop()  # 停止共享文件监听
+    await app.state.dify_http.aclose()
     await app.state.redis.aclose()  # 关闭 Redis 连接
     #退出第三方服务
     #print("stdout: ", mcp_process.stdout)
@@ -0,0 +1,18 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        CREATE TABLE IF NOT EXISTS "chat_archives" (
+    "archive_id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    "task_id" INT NOT NULL UNIQUE,
+    "user_id" INT NOT NULL,
+    "payload" BLOB NOT NULL,
+    "message_count" INT NOT NULL DEFAULT 0,
+    "archived_at" TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DROP TABLE IF EXISTS "chat_archives";"""